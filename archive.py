@@ -0,0 +1,119 @@
+"""Moves sent events out of the live events table into event_history.
+
+Sent one-off events stay around forever otherwise, along with their
+templates and contactsevents rows, and every scheduler scan and profile
+load gets slower as they pile up. Run this daily (cron) so events only
+holds upcoming work:
+    python archive.py              archive what's older than ARCHIVE_AFTER_DAYS
+    python archive.py partition    recreate an empty event_history partitioned by month
+
+Each batch is one statement: it deletes up to ARCHIVE_BATCH_SIZE events
+(contactsevents and outbox rows go by cascade), copies them with their
+template's name and text into event_history, and deletes the templates
+no other event shares.
+Batches commit separately, so a big backlog never holds long locks and an
+interrupted run just picks up where it stopped.
+
+When event_history is partitioned, the month partitions a run needs are
+created before it moves anything.
+"""
+from flask import Flask
+from sqlalchemy import text
+from model import db, connect_to_db
+from migrations import EVENT_HISTORY_COLUMNS
+from template_store import ORPHANS_SQL, sweep
+import datetime, os, sys
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 30)
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or 1000)
+
+# the sub-statements all see the same snapshot, so archived can still read
+# the templates that templates_gone deletes (those no other event shares)
+ARCHIVE_SQL = text("""
+WITH batch AS (
+    SELECT id FROM events
+     WHERE job_done AND recurrence IS NULL AND date < :cutoff
+     ORDER BY date, id
+     LIMIT :limit
+     FOR UPDATE SKIP LOCKED
+), gone AS (
+    DELETE FROM events e USING batch WHERE e.id = batch.id
+    RETURNING e.id, e.date, e.user_id, e.contact_id, e.template_id, e.reminder_sent
+), archived AS (
+    INSERT INTO event_history (id, date, user_id, contact_id, template_name,
+                               template_text, reminder_sent, archived_at)
+    SELECT m.id, m.date, m.user_id, m.contact_id, t.name, t.text, m.reminder_sent, now()
+      FROM gone m JOIN templates t ON t.id = m.template_id
+    RETURNING id
+), templates_gone AS (
+    DELETE FROM templates WHERE id IN (%s)
+)
+SELECT count(*) FROM archived
+""" % ORPHANS_SQL.format(gone='gone'))
+
+MONTHS_SQL = text("SELECT DISTINCT date_trunc('month', date) FROM events "
+                  "WHERE job_done AND recurrence IS NULL AND date < :cutoff")
+PARTITIONED_SQL = text("SELECT 1 FROM pg_partitioned_table p "
+                       "JOIN pg_class c ON c.oid = p.partrelid "
+                       "WHERE c.relname = 'event_history'")
+
+
+def next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def is_partitioned():
+    return db.session.execute(PARTITIONED_SQL).first() is not None
+
+
+def add_partitions(cutoff):
+    """Creates event_history's partitions for every month with events to archive."""
+    for (month,) in db.session.execute(MONTHS_SQL, {'cutoff': cutoff}).fetchall():
+        db.session.execute(
+            "CREATE TABLE IF NOT EXISTS event_history_{:%Y_%m} PARTITION OF event_history "
+            "FOR VALUES FROM ('{:%Y-%m-%d}') TO ('{:%Y-%m-%d}')".format(
+                month, month, next_month(month)))
+    db.session.commit()
+
+
+def archive(now=None, days=None, batch_size=None):
+    """Moves events sent more than days ago into event_history, batch_size
+    at a time; returns how many were moved."""
+    now = now or datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=ARCHIVE_AFTER_DAYS if days is None else days)
+    limit = batch_size or ARCHIVE_BATCH_SIZE
+    if is_partitioned():
+        add_partitions(cutoff)
+    moved = 0
+    while True:
+        count = db.session.execute(ARCHIVE_SQL, {'cutoff': cutoff, 'limit': limit}).scalar()
+        db.session.commit()
+        moved += count
+        if count < limit:
+            return moved
+
+
+def partition():
+    """Recreates event_history partitioned by month; it must still be empty."""
+    db.session.execute("LOCK TABLE event_history")
+    if db.session.execute("SELECT 1 FROM event_history LIMIT 1").first():
+        db.session.rollback()
+        raise ValueError("event_history already has rows; partition it by hand")
+    db.session.execute("DROP TABLE event_history")
+    db.session.execute("CREATE TABLE event_history ({}) PARTITION BY RANGE (date)".format(
+        EVENT_HISTORY_COLUMNS))
+    db.session.execute("CREATE INDEX ix_event_history_user_date "
+                       "ON event_history (user_id, date, id)")
+    db.session.execute("CREATE INDEX ix_event_history_contact ON event_history (contact_id)")
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    app = Flask(__name__)
+    connect_to_db(app)
+    if sys.argv[1:] == ['partition']:
+        partition()
+        print "event_history is now partitioned by month"
+    else:
+        print "archived {} events".format(archive())
+        print "deleted {} unused templates".format(sweep())
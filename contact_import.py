@@ -0,0 +1,211 @@
+"""Bulk import of a user's Facebook friends as contacts.
+
+The friend list is validated once, names the user already has are skipped
+(an index-only lookup on ix_contacts_user_name), and everything left goes
+in with multi-row INSERTs inside a single transaction.
+
+/fb_register doesn't wait for this: it stores the list as an ImportJob and
+a small thread pool works through it a slice at a time, recording progress
+that the profile page polls.
+
+Jobs are claimed the way outbox rows are (FOR UPDATE SKIP LOCKED), so
+two processes resuming at once never run the same job. A worker refreshes
+its claim with every slice; a running job whose claim is older than
+IMPORT_LEASE_SECONDS belonged to a worker that died and can be taken over.
+"""
+from sqlalchemy.exc import SQLAlchemyError
+from delivery import WorkerPool
+from fragment_cache import bump
+from model import Contact, ImportJob, db
+import datetime, json, os, socket, threading
+
+# rows per INSERT statement; keeps each statement well under Postgres' limits
+CHUNK = 1000
+# friends imported per transaction when running as a job; progress is
+# visible after each slice
+SLICE = 500
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS') or 2)
+IMPORT_LEASE_SECONDS = int(os.environ.get('IMPORT_LEASE_SECONDS') or 300)
+NAME_LENGTH = Contact.__table__.c.name.type.length
+
+# jobs nobody is working on: never started, or claimed by a worker that
+# stopped refreshing its claim (claimed_at is NULL for jobs from before 023)
+CLAIMABLE = """status = 'pending'
+                      OR (status = 'running'
+                          AND (claimed_at IS NULL
+                               OR claimed_at < now() - :lease * interval '1 second'))"""
+
+CLAIM_SQL = """
+    UPDATE import_jobs
+       SET status = 'running', claimed_by = :worker, claimed_at = now()
+     WHERE id IN (SELECT id FROM import_jobs
+                   WHERE id = :id
+                     AND ({})
+                   FOR UPDATE SKIP LOCKED)
+ RETURNING id""".format(CLAIMABLE)
+
+# refreshes the claim, and locks the job for the slice being imported;
+# no row means another worker has taken the job over
+HEARTBEAT_SQL = """
+    UPDATE import_jobs SET claimed_at = now()
+     WHERE id = :id AND claimed_by = :worker
+ RETURNING id"""
+
+RESUMABLE_SQL = """
+    SELECT id FROM import_jobs
+     WHERE {}
+     ORDER BY id""".format(CLAIMABLE)
+
+
+def validate(contacts_list):
+    """Splits [name, pic_url] pairs into (rows, failures).
+
+    failures is a list of {'index', 'contact', 'error'} dicts for entries
+    that can't be stored.
+    """
+    rows, failures = [], []
+    for index, entry in enumerate(contacts_list):
+        error = None
+        if not isinstance(entry, (list, tuple)) or not entry:
+            error = "expected [name, pic_url]"
+        else:
+            name = entry[0]
+            pic_url = entry[1] if len(entry) > 1 else None
+            if not isinstance(name, basestring) or not name.strip():
+                error = "missing name"
+            elif len(name.strip()) > NAME_LENGTH:
+                error = "name longer than {} characters".format(NAME_LENGTH)
+            elif pic_url is not None and not isinstance(pic_url, basestring):
+                error = "pic_url must be a string"
+        if error:
+            failures.append({'index': index, 'contact': entry, 'error': error})
+        else:
+            rows.append({'name': name.strip(), 'pic_url': pic_url or None})
+    return rows, failures
+
+
+def import_contacts(user_id, contacts_list):
+    """Adds the friends in contacts_list to user_id's contacts.
+
+    Returns {'added': n, 'skipped': n, 'failed': [...]}; skipped counts
+    names the user already had (or that appeared twice in the list).
+    """
+    rows, failures = validate(contacts_list)
+    existing = set(name for (name,) in
+                   db.session.query(Contact.name).filter(Contact.user_id == user_id))
+    new_rows = []
+    for row in rows:
+        if row['name'] in existing:
+            continue
+        existing.add(row['name'])
+        row['user_id'] = user_id
+        if row['pic_url'] is None:
+            del row['pic_url']      # keep the column default picture
+        new_rows.append(row)
+    skipped = len(rows) - len(new_rows)
+
+    # rows with and without pic_url need different column lists
+    with_pic = [row for row in new_rows if 'pic_url' in row]
+    without_pic = [row for row in new_rows if 'pic_url' not in row]
+    try:
+        for group in (with_pic, without_pic):
+            for i in range(0, len(group), CHUNK):
+                db.session.execute(Contact.__table__.insert().values(group[i:i + CHUNK]))
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        failures.extend({'contact': [row['name'], row.get('pic_url')], 'error': str(e)}
+                        for row in new_rows)
+        return {'added': 0, 'skipped': skipped, 'failed': failures}
+    return {'added': len(new_rows), 'skipped': skipped, 'failed': failures}
+
+
+_pool = None
+
+
+def _workers():
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(IMPORT_WORKERS, name='import')
+    return _pool
+
+
+def enqueue_import(user_id, contacts_list):
+    """Store contacts_list as a pending ImportJob and start it in the
+    background; returns the job."""
+    job = ImportJob(user_id=user_id, payload=json.dumps(contacts_list),
+                    total=len(contacts_list))
+    db.session.add(job)
+    db.session.commit()
+    _workers().submit(run_import, job.id)
+    return job
+
+
+def worker_id():
+    """Identifies this thread in claimed_by."""
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(),
+                             threading.current_thread().name)
+
+
+def claim(job_id, worker):
+    """Claims job_id for worker if nobody else holds it; returns the job or None."""
+    claimed = db.session.execute(CLAIM_SQL, {'id': job_id, 'worker': worker,
+                                             'lease': IMPORT_LEASE_SECONDS}).first()
+    db.session.commit()
+    return ImportJob.query.get(job_id) if claimed else None
+
+
+def run_import(job_id):
+    """Import one job's friends, SLICE at a time, updating its progress."""
+    worker = worker_id()
+    try:
+        job = claim(job_id, worker)
+        if job is None:
+            return
+        contacts_list = json.loads(job.payload)
+        failures = json.loads(job.failures or '[]')
+        # a restarted job picks up after the last committed slice
+        for start in range(job.processed, len(contacts_list), SLICE):
+            alive = db.session.execute(HEARTBEAT_SQL, {'id': job_id, 'worker': worker})
+            if alive.first() is None:
+                db.session.rollback()
+                return
+            result = import_contacts(job.user_id, contacts_list[start:start + SLICE])
+            for failure in result['failed']:
+                if 'index' in failure:
+                    failure['index'] += start
+            failures.extend(result['failed'])
+            job.processed = min(start + SLICE, len(contacts_list))
+            job.added += result['added']
+            job.skipped += result['skipped']
+            job.failures = json.dumps(failures)
+            db.session.commit()
+            bump(job.user_id)
+        job.status = 'done'
+        job.finished_at = datetime.datetime.now()
+        db.session.commit()
+    except Exception as e:
+        print "import job {} failed: {}".format(job_id, e)
+        db.session.rollback()
+        ImportJob.query.filter(ImportJob.id == job_id, ImportJob.claimed_by == worker).update(
+            {'status': 'failed', 'finished_at': datetime.datetime.now()})
+        db.session.commit()
+    finally:
+        db.session.remove()
+
+
+def resume_imports():
+    """Requeue jobs that are pending, or whose worker died part way through;
+    jobs another live process is running are left alone."""
+    unfinished = db.session.execute(RESUMABLE_SQL, {'lease': IMPORT_LEASE_SECONDS}).fetchall()
+    db.session.commit()
+    for (job_id,) in unfinished:
+        _workers().submit(run_import, job_id)
+    return len(unfinished)
+
+
+def job_status(job):
+    """JSON-ready progress for the status endpoint."""
+    return {'id': job.id, 'status': job.status, 'total': job.total,
+            'processed': job.processed, 'added': job.added, 'skipped': job.skipped,
+            'failed': json.loads(job.failures or '[]')}
@@ -0,0 +1,137 @@
+"""Concurrent fan-out of the scheduler's emails and texts.
+
+Messages are rendered from the ORM on the scheduler thread and handed to
+the engine as plain callables, so worker threads never touch the session.
+"""
+from collections import namedtuple
+import Queue, threading, time
+
+
+# key identifies the message in the Report (an event id, or an outbox row id);
+# send is a zero-argument callable that makes the provider request
+Message = namedtuple('Message', ['key', 'channel', 'provider', 'send'])
+
+
+def percentile(values, p):
+    """p-th percentile (0-100) of values by nearest rank; 0 if empty."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class Pending(object):
+    """Result of a call handed to a WorkerPool."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def _finish(self, value=None, error=None):
+        self._value, self._error = value, error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the call; return its value or re-raise its exception."""
+        if not self._done.wait(timeout):
+            raise RuntimeError("call still pending after {}s".format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class WorkerPool(object):
+    """Fixed set of daemon threads running callables off a shared queue."""
+
+    def __init__(self, size, name='worker'):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(name='{}-{}'.format(name, i), target=self._run)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            pending, fn, args, kwargs = item
+            try:
+                pending._finish(value=fn(*args, **kwargs))
+            except Exception as e:
+                pending._finish(error=e)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs); returns a Pending for its result."""
+        pending = Pending()
+        self._queue.put((pending, fn, args, kwargs))
+        return pending
+
+    def shutdown(self):
+        """Let queued calls finish, then stop the threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+
+class Report(object):
+    """Outcome of one DeliveryEngine.deliver() run."""
+
+    def __init__(self):
+        self.sent = []      # (key, channel)
+        self.failed = []    # (key, channel, exception)
+        self.elapsed = 0.0
+
+    def ok(self, key):
+        """True if no message for key failed."""
+        return all(k != key for k, _, _ in self.failed)
+
+    def extend(self, other):
+        """Adds another Report's outcomes to this one."""
+        self.sent.extend(other.sent)
+        self.failed.extend(other.failed)
+
+    def rate(self):
+        """Messages per second, successful or not."""
+        total = len(self.sent) + len(self.failed)
+        return total / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return "<Report sent={} failed={} {:.1f} msg/s>".format(
+            len(self.sent), len(self.failed), self.rate())
+
+
+class DeliveryEngine(object):
+    """Sends Messages concurrently, one worker pool per provider.
+
+    limits maps a provider name to the most requests it may have in flight;
+    each message's channel is sent independently of its event's others.
+    """
+
+    def __init__(self, limits):
+        self.pools = dict((provider, WorkerPool(n, name=provider))
+                          for provider, n in limits.items())
+
+    def deliver(self, messages):
+        """Send every message; block until all finish; return a Report."""
+        report = Report()
+        start = time.time()
+        pending = [(m, self.pools[m.provider].submit(m.send)) for m in messages]
+        for m, p in pending:
+            try:
+                p.result()
+                report.sent.append((m.key, m.channel))
+            except Exception as e:
+                print "FAILED {} for {}: {}".format(m.channel, m.key, e)
+                report.failed.append((m.key, m.channel, e))
+        report.elapsed = time.time() - start
+        return report
@@ -0,0 +1,113 @@
+"""Batched email sending through SendGrid's v3 mail/send API.
+
+One request can carry up to MAX_PERSONALIZATIONS recipients as long as they
+share a sender, so the daily run makes a handful of calls instead of one per
+email. Each recipient gets its own subject and body through a substitution.
+"""
+from collections import deque, namedtuple
+from delivery import Report
+import metrics, sendgrid, threading, time
+
+
+# key maps the result back to its row (an event id or an outbox row id)
+OutgoingEmail = namedtuple('OutgoingEmail', ['key', 'from_email', 'from_name',
+                                             'to_email', 'to_name', 'subject', 'body'])
+
+BODY_TAG = '-body-'
+
+
+class SendGridBatcher(object):
+    """Keeps one SendGrid client and packs emails into multi-recipient calls.
+
+    host can point at a local stub server for tests and benchmarks.
+    """
+
+    MAX_PERSONALIZATIONS = 1000
+
+    def __init__(self, apikey, host='https://api.sendgrid.com', batch_size=None):
+        self.sg = sendgrid.SendGridAPIClient(apikey=apikey, host=host)
+        self.batch_size = min(batch_size or self.MAX_PERSONALIZATIONS,
+                              self.MAX_PERSONALIZATIONS)
+        self.requests = 0
+        self._lock = threading.Lock()   # batches may be sent from several threads
+        self.latencies = deque(maxlen=10000)    # seconds, most recent requests
+
+    def batches(self, emails):
+        """Splits emails into (sender, emails) batches of at most batch_size,
+        each of which is one request; send_batch() them in parallel."""
+        by_sender = {}
+        for email in emails:
+            by_sender.setdefault((email.from_email, email.from_name), []).append(email)
+        return [(sender, group[i:i + self.batch_size])
+                for sender, group in by_sender.items()
+                for i in range(0, len(group), self.batch_size)]
+
+    def send_batch(self, sender, emails):
+        """Sends one batch from batches(); returns its Report."""
+        report = Report()
+        start = time.time()
+        self._send_batch(sender, emails, report)
+        report.elapsed = time.time() - start
+        return report
+
+    def send(self, emails):
+        """Sends every OutgoingEmail, one batch after another; returns a
+        Report keyed by email.key."""
+        report = Report()
+        start = time.time()
+        for sender, batch in self.batches(emails):
+            report.extend(self.send_batch(sender, batch))
+        report.elapsed = time.time() - start
+        return report
+
+    def _send_batch(self, sender, emails, report):
+        """Posts one batch. A 400 means some recipient was rejected, so the
+        batch is split in half until the bad ones are isolated."""
+        status, error = self._post(self.request_body(sender, emails))
+        if error is None:
+            report.sent.extend((email.key, 'email') for email in emails)
+        elif status == 400 and len(emails) > 1:
+            half = len(emails) // 2
+            self._send_batch(sender, emails[:half], report)
+            self._send_batch(sender, emails[half:], report)
+        else:
+            print "FAILED email batch of {}: {}".format(len(emails), error)
+            report.failed.extend((email.key, 'email', error) for email in emails)
+
+    def _post(self, body):
+        """Returns (status code, exception or None)."""
+        with self._lock:
+            self.requests += 1
+        start = time.time()
+        try:
+            response = self.sg.client.mail.send.post(request_body=body)
+        except Exception as e:
+            # python_http_client raises HTTPError (with status_code) on 4xx/5xx
+            status = getattr(e, 'status_code', None)
+            if status is None:
+                return None, e
+            return status, RuntimeError("SendGrid returned {}".format(status))
+        finally:
+            elapsed = time.time() - start
+            metrics.observe('provider_request_seconds', elapsed, provider='sendgrid')
+            self.latencies.append(elapsed)
+        if response.status_code >= 300:
+            return response.status_code, RuntimeError(
+                "SendGrid returned {}".format(response.status_code))
+        return response.status_code, None
+
+    @staticmethod
+    def request_body(sender, emails):
+        """v3 mail/send body: one personalization per email."""
+        from_email, from_name = sender
+        personalizations = []
+        for email in emails:
+            personalizations.append({
+                'to': [{'email': email.to_email, 'name': email.to_name}],
+                'subject': email.subject,
+                'substitutions': {BODY_TAG: email.body},
+                'custom_args': {'key': str(email.key)},
+            })
+        return {'personalizations': personalizations,
+                'from': {'email': from_email, 'name': from_name},
+                'content': [{'type': 'text/plain', 'value': BODY_TAG}]}
@@ -0,0 +1,156 @@
+"""Creating events (with their templates, contacts and contactsevents rows)
+in bulk.
+
+Every event form and the batch API go through create_events(), which
+writes everything in one transaction with a multi-row INSERT per table,
+so scheduling 400 birthday messages costs the same handful of statements
+as scheduling one.
+"""
+from model import Contact, ContactEvent, Event, db
+from recurrence import RULES
+from template_store import intern
+import datetime
+
+CONTACT_FIELDS = ('name', 'email', 'phone', 'address')
+
+
+class BatchError(ValueError):
+    """Raised with a list of {'index', 'error'} dicts when entries are invalid."""
+
+    def __init__(self, errors):
+        ValueError.__init__(self, "{} invalid entries".format(len(errors)))
+        self.errors = errors
+
+
+def parse_date(value):
+    """Form dates come in as YYYY-MM-DD."""
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def parse_recurrence(fields):
+    """(recurrence or None, recur_every) from a form or batch entry; raises
+    ValueError with a message for the user if they're invalid."""
+    recurrence = fields.get('recurrence') or None
+    if recurrence is not None and recurrence not in RULES:
+        raise ValueError("recurrence must be one of {}".format(', '.join(RULES)))
+    try:
+        every = int(fields.get('recur_every') or 1)
+    except (TypeError, ValueError):
+        every = 0
+    if every < 1:
+        raise ValueError("recur_every must be a positive integer")
+    return recurrence, every
+
+
+def message_text(contact_name, body, user_fname, greet="Hi", sign_off="Best"):
+    contact_fname = contact_name.split()[0] if contact_name.strip() else contact_name
+    return u"{} {}, \n{} \n{},\n{}".format(greet, contact_fname, body, sign_off, user_fname)
+
+
+def _next_ids(table, n):
+    """Reserve n primary keys from table's sequence in one round trip."""
+    if not n:
+        return []
+    rows = db.session.execute(
+        "SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :n)",
+        {'table': table.name, 'n': n})
+    return [row[0] for row in rows]
+
+
+def _insert(table, rows):
+    if rows:
+        db.session.execute(table.insert().values(rows))
+
+
+def create_events(user, entries):
+    """Schedule one event per entry for user; returns the new event ids.
+
+    An entry is a dict with date, template_name and body, plus either
+    contact_id (an existing contact, whose name/email/phone/address are
+    updated if given) or the fields of a new contact. greet and sign_off
+    are optional, and so are recurrence (one of recurrence.RULES) and
+    recur_every (default 1). Nothing is written if any entry is invalid.
+    """
+    # entry index -> its contact_id as an int, or None if it isn't one; the
+    # loop below reports the bad ones with the rest of each entry's errors
+    contact_ids = {}
+    for index, entry in enumerate(entries):
+        if entry.get('contact_id'):
+            try:
+                contact_ids[index] = int(entry['contact_id'])
+            except (TypeError, ValueError):
+                contact_ids[index] = None
+    existing = {}
+    valid_ids = set(i for i in contact_ids.values() if i is not None)
+    if valid_ids:
+        existing = dict((c.id, c) for c in Contact.query.filter(
+            Contact.user_id == user.id, Contact.id.in_(valid_ids)))
+
+    errors, new_contacts, planned = [], [], []
+    for index, entry in enumerate(entries):
+        try:
+            date = parse_date(entry.get('date'))
+        except (TypeError, ValueError):
+            errors.append({'index': index, 'error': "date must be YYYY-MM-DD"})
+            continue
+        if not entry.get('template_name'):
+            errors.append({'index': index, 'error': "missing template_name"})
+            continue
+        try:
+            recurrence, every = parse_recurrence(entry)
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+            continue
+        if index in contact_ids:
+            if contact_ids[index] is None:
+                errors.append({'index': index, 'error': "contact_id must be an integer"})
+                continue
+            contact = existing.get(contact_ids[index])
+            if contact is None:
+                errors.append({'index': index, 'error': "no such contact"})
+                continue
+            for field in CONTACT_FIELDS:
+                if entry.get(field):
+                    setattr(contact, field, entry[field])
+            name = contact.name
+        else:
+            if not entry.get('name'):
+                errors.append({'index': index, 'error': "missing contact name"})
+                continue
+            contact = dict((field, entry.get(field)) for field in CONTACT_FIELDS)
+            contact['user_id'] = user.id
+            new_contacts.append(contact)
+            name = contact['name']
+        text = message_text(name, entry.get('body') or '', user.fname,
+                            entry.get('greet') or "Hi", entry.get('sign_off') or "Best")
+        planned.append((contact, date, entry['template_name'], text, recurrence, every))
+    if errors:
+        db.session.rollback()
+        raise BatchError(errors)
+
+    for contact, contact_id in zip(new_contacts,
+                                   _next_ids(Contact.__table__, len(new_contacts))):
+        contact['id'] = contact_id
+    # identical messages share one templates row
+    template_ids = intern([(template_name, text)
+                           for _, _, template_name, text, _, _ in planned])
+    event_ids = _next_ids(Event.__table__, len(planned))
+    events, links = [], []
+    for (contact, date, template_name, text, recurrence, every), template_id, event_id in zip(
+            planned, template_ids, event_ids):
+        contact_id = contact['id'] if isinstance(contact, dict) else contact.id
+        events.append({'id': event_id, 'contact_id': contact_id, 'user_id': user.id,
+                       'template_id': template_id, 'date': date,
+                       'reminder_sent': False, 'job_done': False,
+                       'recurrence': recurrence, 'recur_every': every,
+                       'recurs_from': date if recurrence else None})
+        links.append({'contact_id': contact_id, 'event_id': event_id})
+    _insert(Contact.__table__, new_contacts)
+    _insert(Event.__table__, events)
+    _insert(ContactEvent.__table__, links)
+    db.session.commit()
+    return event_ids
@@ -0,0 +1,86 @@
+"""Cache of rendered /profile sections, per user.
+
+Fragments are keyed by user, a per-user version token and the fragment
+name. Write routes call bump(user_id), which swaps in a new version so
+every older fragment for that user simply stops being looked up; nothing
+has to be deleted. If the version itself is evicted a fresh token is made,
+which again can't match anything stale.
+
+Flags flipped by the scheduler and outbox workers don't bump versions
+(the workers may not even share this process), so fragments also expire
+after FRAGMENT_TTL seconds.
+
+The backend is anything with get(key) and set(key, value, ttl); the
+default is an in-process LRU, and a shared store such as memcached can be
+dropped in for multi-process deployments.
+"""
+from collections import OrderedDict
+import os, threading, time, uuid
+
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 5000)
+FRAGMENT_TTL = int(os.environ.get('FRAGMENT_TTL') or 300)
+
+
+class LRUBackend(object):
+    """Thread-safe in-process LRU with per-entry expiry."""
+
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()     # key -> (expires at or None, value)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                return None
+            self._data[key] = entry     # most recently used goes last
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl if ttl else None, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class FragmentCache(object):
+    """Rendered fragments per (user, version, name)."""
+
+    def __init__(self, backend=None, ttl=FRAGMENT_TTL):
+        self.backend = backend or LRUBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, user_id):
+        key = 'version:{}'.format(user_id)
+        version = self.backend.get(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            self.backend.set(key, version)
+        return version
+
+    def bump(self, user_id):
+        """Invalidate everything cached for user_id."""
+        if user_id:
+            self.backend.set('version:{}'.format(user_id), uuid.uuid4().hex)
+
+    def get_or_render(self, user_id, name, render):
+        """Cached fragment name for user_id, calling render() on a miss."""
+        key = 'fragment:{}:{}:{}'.format(user_id, self.version(user_id), name)
+        html = self.backend.get(key)
+        if html is None:
+            self.misses += 1
+            html = render()
+            self.backend.set(key, html, self.ttl)
+        else:
+            self.hits += 1
+        return html
+
+
+fragments = FragmentCache()
+bump = fragments.bump
@@ -0,0 +1,113 @@
+"""In-process counters and latency histograms, served by /metrics in the
+Prometheus text exposition format."""
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import threading, time
+
+# Upper bounds (seconds) for latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds for SQL queries per request
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Registry(object):
+    """Thread-safe store of counters and histograms, keyed by name + labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}      # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [bucket counts, sum, count]
+        self.buckets = {}       # name -> bucket bounds
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            bounds = self.buckets.setdefault(name, buckets)
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(bounds), 0.0, 0]
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the with-block took, in seconds."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2]))
+                                for k, v in self.histograms.items())
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE {} counter".format(name))
+                typed.add(name)
+            lines.append("{}{} {}".format(name, _labels(labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                lines.append("# TYPE {} histogram".format(name))
+                typed.add(name)
+            for bound, n in zip(self.buckets[name], counts):
+                lines.append("{}_bucket{} {}".format(name, _labels(labels, le=bound), n))
+            lines.append("{}_bucket{} {}".format(name, _labels(labels, le='+Inf'), count))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+            lines.append("{}_count{} {}".format(name, _labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    inc('sql_queries_total')
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+
+
+def instrument_app(app):
+    """Time every Flask request and count its SQL queries."""
+
+    @app.before_request
+    def _start_timer():
+        g.request_started = time.time()
+        g.sql_queries = 0
+
+    @app.after_request
+    def _record_request(response):
+        if 'request_started' in g:
+            endpoint = request.endpoint or 'unknown'
+            observe('http_request_seconds', time.time() - g.request_started,
+                    endpoint=endpoint, method=request.method)
+            observe('http_request_sql_queries', g.sql_queries,
+                    buckets=QUERY_BUCKETS, endpoint=endpoint)
+            inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+        return response
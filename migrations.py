@@ -0,0 +1,226 @@
+"""Versioned schema changes for databases created before the models changed.
+
+db.create_all() only creates missing tables; it never touches tables that
+already exist, so new columns and indexes on old tables are added here.
+
+    python migrations.py           apply whatever hasn't been applied yet
+    python migrations.py status    list applied and pending migrations
+
+Applied migrations are recorded by name in schema_version. Ordinary
+migrations run in one transaction each. Index migrations use CREATE INDEX
+CONCURRENTLY so production tables stay writable while the index builds;
+that can't run in a transaction, and an interrupted build leaves an
+invalid index behind, which is dropped and rebuilt on the next run.
+Statements are still written to be safe to re-run, because databases
+upgraded before schema_version existed have some of them already.
+"""
+from collections import namedtuple
+from flask import Flask
+from sqlalchemy import text
+from model import db, connect_to_db
+import datetime, sys
+
+# index is the index name for CREATE INDEX CONCURRENTLY migrations, else None
+Migration = namedtuple('Migration', ['name', 'statements', 'index'])
+
+
+def sql(name, *statements):
+    """A migration whose statements run in one transaction."""
+    return Migration(name, statements, None)
+
+
+def index(name, index_name, definition, unique=False):
+    """A migration building one index without locking out writes."""
+    return Migration(name, ["CREATE {}INDEX CONCURRENTLY IF NOT EXISTS {} ON {}".format(
+        'UNIQUE ' if unique else '', index_name, definition)], index_name)
+
+
+# shared with archive.py, which can recreate the table partitioned by month
+EVENT_HISTORY_COLUMNS = (
+    "id INTEGER NOT NULL, "
+    "date TIMESTAMP NOT NULL, "
+    "user_id INTEGER NOT NULL REFERENCES users (id), "
+    "contact_id INTEGER NOT NULL REFERENCES contacts (id) ON DELETE CASCADE, "
+    "template_name VARCHAR(64) NOT NULL, "
+    "template_text TEXT NOT NULL, "
+    "reminder_sent BOOLEAN, "
+    "archived_at TIMESTAMP NOT NULL DEFAULT now(), "
+    "PRIMARY KEY (id, date)")
+
+# applied in list order and recorded by name, so never rename a released one
+MIGRATIONS = [
+    index("001_events_due_index", "ix_events_due",
+          "events (date, job_done, reminder_sent)"),
+    sql("002_outbox",
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "id SERIAL PRIMARY KEY, "
+        "event_id INTEGER NOT NULL REFERENCES events (id), "
+        "kind VARCHAR(10) NOT NULL, "
+        "channel VARCHAR(10) NOT NULL, "
+        "status VARCHAR(10) NOT NULL DEFAULT 'pending', "
+        "attempts INTEGER NOT NULL DEFAULT 0, "
+        "claimed_by VARCHAR(64), "
+        "claimed_at TIMESTAMP, "
+        "sent_at TIMESTAMP, "
+        "last_error TEXT, "
+        "created_at TIMESTAMP NOT NULL DEFAULT now(), "
+        "UNIQUE (event_id, kind, channel))"),
+    index("003_outbox_status_index", "ix_outbox_status", "outbox (status, id)"),
+    sql("004_users_timezone",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone VARCHAR(64) "
+        "NOT NULL DEFAULT 'America/Los_Angeles'"),
+    index("005_contacts_user_name_index", "ix_contacts_user_name",
+          "contacts (user_id, name, id)"),
+    index("006_events_user_date_index", "ix_events_user_date", "events (user_id, date, id)"),
+    index("007_events_contact_index", "ix_events_contact", "events (contact_id)"),
+    sql("008_import_jobs",
+        "CREATE TABLE IF NOT EXISTS import_jobs ("
+        "id SERIAL PRIMARY KEY, "
+        "user_id INTEGER NOT NULL REFERENCES users (id), "
+        "status VARCHAR(10) NOT NULL DEFAULT 'pending', "
+        "payload TEXT NOT NULL, "
+        "total INTEGER NOT NULL DEFAULT 0, "
+        "processed INTEGER NOT NULL DEFAULT 0, "
+        "added INTEGER NOT NULL DEFAULT 0, "
+        "skipped INTEGER NOT NULL DEFAULT 0, "
+        "failures TEXT, "
+        "created_at TIMESTAMP NOT NULL DEFAULT now(), "
+        "finished_at TIMESTAMP)"),
+    index("009_import_jobs_status_index", "ix_import_jobs_status", "import_jobs (status, id)"),
+    sql("010_cascade_deletes",
+        "ALTER TABLE events DROP CONSTRAINT IF EXISTS events_contact_id_fkey, "
+        "ADD CONSTRAINT events_contact_id_fkey FOREIGN KEY (contact_id) "
+        "REFERENCES contacts (id) ON DELETE CASCADE",
+        "ALTER TABLE contactsevents DROP CONSTRAINT IF EXISTS contactsevents_contact_id_fkey, "
+        "ADD CONSTRAINT contactsevents_contact_id_fkey FOREIGN KEY (contact_id) "
+        "REFERENCES contacts (id) ON DELETE CASCADE, "
+        "DROP CONSTRAINT IF EXISTS contactsevents_event_id_fkey, "
+        "ADD CONSTRAINT contactsevents_event_id_fkey FOREIGN KEY (event_id) "
+        "REFERENCES events (id) ON DELETE CASCADE",
+        "ALTER TABLE outbox DROP CONSTRAINT IF EXISTS outbox_event_id_fkey, "
+        "ADD CONSTRAINT outbox_event_id_fkey FOREIGN KEY (event_id) "
+        "REFERENCES events (id) ON DELETE CASCADE"),
+    # the cascades look up child rows by these columns
+    index("011_contactsevents_contact_index", "ix_contactsevents_contact",
+          "contactsevents (contact_id)"),
+    index("011_contactsevents_event_index", "ix_contactsevents_event",
+          "contactsevents (event_id)"),
+    # same rules as phones.to_e164 with the default country code 1; where
+    # several users share a number only the oldest account gets it
+    sql("012_users_phone_e164",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS phone_e164 VARCHAR(16)",
+        "UPDATE users SET phone_e164 = n.e164 FROM ("
+        " SELECT DISTINCT ON (e164) id, e164 FROM ("
+        "  SELECT id, '+' || CASE"
+        "   WHEN btrim(phone) LIKE '+%%' THEN digits"
+        "   WHEN btrim(phone) LIKE '00%%' THEN substr(digits, 3)"
+        "   WHEN length(digits) = 11 AND digits LIKE '1%%' THEN digits"
+        "   ELSE '1' || digits END AS e164"
+        "  FROM (SELECT id, phone, regexp_replace(phone, '[^0-9]', '', 'g') AS digits"
+        "        FROM users WHERE phone IS NOT NULL) p) x"
+        " WHERE length(e164) BETWEEN 9 AND 16 AND e164 NOT LIKE '+0%%'"
+        " ORDER BY e164, id) n "
+        "WHERE users.id = n.id AND users.phone_e164 IS NULL "
+        "AND NOT EXISTS (SELECT 1 FROM users o WHERE o.phone_e164 = n.e164)"),
+    index("012_users_phone_e164_index", "ix_users_phone_e164", "users (phone_e164)",
+          unique=True),
+    sql("013_contacts_version",
+        "ALTER TABLE contacts ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1, "
+        "ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()"),
+    # /login and /register look users up by email
+    index("014_users_email_index", "ix_users_email", "users (email)"),
+    sql("015_event_history", "CREATE TABLE IF NOT EXISTS event_history ({})".format(
+        EVENT_HISTORY_COLUMNS)),
+    index("016_event_history_user_date_index", "ix_event_history_user_date",
+          "event_history (user_id, date, id)"),
+    index("017_event_history_contact_index", "ix_event_history_contact",
+          "event_history (contact_id)"),
+    sql("018_events_recurrence",
+        "ALTER TABLE events ADD COLUMN IF NOT EXISTS recurrence VARCHAR(10), "
+        "ADD COLUMN IF NOT EXISTS recur_every INTEGER DEFAULT 1, "
+        "ADD COLUMN IF NOT EXISTS recurs_from TIMESTAMP"),
+    index("019_events_recurring_done_index", "ix_events_recurring_done",
+          "events (id) WHERE job_done = true AND recurrence IS NOT NULL"),
+    index("020_events_template_index", "ix_events_template", "events (template_id)"),
+    # same digest as model.template_digest; duplicates collapse onto the
+    # oldest row before the unique index goes on
+    sql("021_templates_digest",
+        "ALTER TABLE templates ADD COLUMN IF NOT EXISTS digest VARCHAR(64)",
+        "UPDATE templates SET digest = encode(sha256(convert_to("
+        "length(name) || ':' || name || text, 'UTF8')), 'hex') WHERE digest IS NULL",
+        "UPDATE events SET template_id = k.keep FROM ("
+        " SELECT id, min(id) OVER (PARTITION BY digest) AS keep FROM templates) k "
+        "WHERE events.template_id = k.id AND k.id <> k.keep",
+        "DELETE FROM templates USING ("
+        " SELECT id, min(id) OVER (PARTITION BY digest) AS keep FROM templates) k "
+        "WHERE templates.id = k.id AND k.id <> k.keep",
+        "ALTER TABLE templates ALTER COLUMN digest SET NOT NULL"),
+    index("022_templates_digest_index", "ix_templates_digest", "templates (digest)",
+          unique=True),
+    sql("023_import_jobs_claim",
+        "ALTER TABLE import_jobs ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(64), "
+        "ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP"),
+]
+
+
+VERSION_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS schema_version ("
+                     "name VARCHAR(64) PRIMARY KEY, "
+                     "applied_at TIMESTAMP NOT NULL DEFAULT now())")
+INVALID_INDEX_SQL = text("SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                         "WHERE c.relname = :name AND NOT i.indisvalid")
+
+
+def applied():
+    """Names of the migrations already applied, in order."""
+    db.engine.execute(VERSION_TABLE_SQL)
+    rows = db.engine.execute("SELECT name FROM schema_version ORDER BY name")
+    return [name for (name,) in rows]
+
+
+def pending():
+    """Migrations not yet applied, in the order they should run."""
+    done = set(applied())
+    return [migration for migration in MIGRATIONS if migration.name not in done]
+
+
+def record(conn, name):
+    conn.execute(text("INSERT INTO schema_version (name, applied_at) VALUES (:name, :at)"),
+                 name=name, at=datetime.datetime.now())
+
+
+def apply(migration):
+    """Run one migration and record it in schema_version."""
+    if migration.index is None:
+        with db.engine.begin() as conn:
+            for statement in migration.statements:
+                conn.execute(statement)
+            record(conn, migration.name)
+        return
+    conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        if conn.execute(INVALID_INDEX_SQL, name=migration.index).first():
+            conn.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(migration.index))
+        for statement in migration.statements:
+            conn.execute(statement)
+        record(conn, migration.name)
+    finally:
+        conn.close()
+
+
+def upgrade():
+    """Apply every pending migration to the connected database."""
+    for migration in pending():
+        apply(migration)
+        print "applied {}".format(migration.name)
+
+
+if __name__ == "__main__":
+    app = Flask(__name__)
+    connect_to_db(app)
+    if sys.argv[1:] == ['status']:
+        done = set(applied())
+        for migration in MIGRATIONS:
+            print "{} {}".format("applied" if migration.name in done else "pending",
+                                 migration.name)
+    else:
+        upgrade()
@@ -1,11 +1,55 @@
 """Models and database functions for project."""
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-import time, datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy.orm import validates
+from sqlalchemy import event, exc
+from contextlib import contextmanager
+import sqlalchemy
+from phones import to_e164
+import hashlib, os, time, datetime
 
 
-db = SQLAlchemy()
+class RoutingSession(SignallingSession):
+    """Session that sends queries to the read replica inside replica()
+    blocks. Flushes always go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self.info.get('replica') and not self._flushing and
+                self.app.config['SQLALCHEMY_BINDS'] and
+                'replica' in self.app.config['SQLALCHEMY_BINDS']):
+            return db.get_engine(self.app, bind='replica')
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with replica routing and optional pre-ping on checkout."""
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING') and not getattr(engine, 'pre_ping', False):
+            event.listen(engine.pool, 'checkout', _ping)
+            engine.pre_ping = True
+        return engine
+
+
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    """Test a pooled connection before handing it out; the pool replaces it
+    (up to three tries) if the server dropped it."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+db = RoutingSQLAlchemy()
+
+DEFAULT_TIMEZONE = 'America/Los_Angeles'
 
 ##############################################################################
 # Model definitions
@@ -21,22 +65,34 @@ class User(db.Model):
     fname = db.Column(db.String(20)) # make nullable=False after testing, for more refined log in/register page
     lname = db.Column(db.String(20)) # make nullable=False after testing, for more refined log in/register page
     phone = db.Column(db.String(15))
+    # phone as E.164, kept in sync by _normalize_phone; /sms looks users up by it
+    phone_e164 = db.Column(db.String(16))
     fb_uid = db.Column(db.Text)
     fb_at = db.Column(db.Text)
     pic_url = db.Column(db.Text) # picture from FB
+    # IANA zone name; the scheduler sends at SEND_HOUR in the user's local time
+    timezone = db.Column(db.String(64), default=DEFAULT_TIMEZONE, nullable=False)
+    __table_args__ = (db.Index('ix_users_phone_e164', 'phone_e164', unique=True),
+                      db.Index('ix_users_email', 'email'))
 
 
-    def __init__(self, email, password, fname, lname, phone='', fb_uid='', fb_at='', pic_url=''):
+    def __init__(self, email, password, fname, lname, phone='', fb_uid='', fb_at='', pic_url='', timezone=None):
         self.email = email
-        self.password = generate_password_hash(password)
+        self.password = password # already hashed by passwords.hash_password
         self.fname = fname
         self.lname = lname
         self.phone = phone
         self.fb_uid = fb_uid
         self.fb_at = fb_at
         self.pic_url=pic_url
+        self.timezone = timezone or DEFAULT_TIMEZONE
         
 
+    @validates('phone')
+    def _normalize_phone(self, key, phone):
+        self.phone_e164 = to_e164(phone)
+        return phone
+
     def __repr__(self):
         """Provide better representation."""
         return "<User id={} fname={} email={}>".format(self.id, self.fname, self.email)
@@ -54,9 +110,16 @@ class Contact(db.Model):
     phone = db.Column(db.String(15))
     address = db.Column(db.Text) # address information
     pic_url = db.Column(db.Text, default="/static/defaultpic.jpg") # picture from FB
+    # bumped on every ORM update; /contacts.json builds its ETag from these
+    version = db.Column(db.Integer, default=1, onupdate=sqlalchemy.literal_column('contacts.version + 1'),
+                        nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.now,
+                           onupdate=datetime.datetime.now, nullable=False)
     # A contact belongs to a user
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     user = db.relationship("User", backref=db.backref("contacts", order_by=id))
+    # the profile pages through a user's contacts by (name, id)
+    __table_args__ = (db.Index('ix_contacts_user_name', 'user_id', 'name', 'id'),)
 
     def __repr__(self):
         """Provide better representation."""
@@ -70,19 +133,36 @@ class Event(db.Model):
     __tablename__ = "events"
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    contact_id = db.Column(db.Integer, db.ForeignKey('contacts.id'), nullable=False)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contacts.id', ondelete='CASCADE'), nullable=False)
     template_id = db.Column(db.Integer, db.ForeignKey('templates.id'), nullable=False)
     #default date is tomorrow
     date = db.Column(db.DateTime, default=(datetime.datetime.today() + datetime.timedelta(days=1)), nullable=False)
     # if reminder is sent
     reminder_sent = db.Column(db.Boolean, default=False)
     job_done = db.Column(db.Boolean, default=False)
+    # repeating events ('yearly', 'monthly' or 'daily', every recur_every of
+    # those from recurs_from) keep date at their next occurrence; recurrence.py
+    # moves it forward after each send
+    recurrence = db.Column(db.String(10))
+    recur_every = db.Column(db.Integer, default=1)
+    recurs_from = db.Column(db.DateTime)
     # an event has one contact, and a contact can have multiple events
     contacts = db.relationship("Contact", secondary="contactsevents", backref="events")
     template = db.relationship("Template", backref=db.backref("event"))
     # add this relationship because I'm querying often for a user's events
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     user = db.relationship("User", backref=db.backref("events"))
+    # the scheduler scans by day for rows that still need sending
+    __table_args__ = (db.Index('ix_events_due', 'date', 'job_done', 'reminder_sent'),
+                      # the profile pages through a user's events by (date, id)
+                      db.Index('ix_events_user_date', 'user_id', 'date', 'id'),
+                      db.Index('ix_events_contact', 'contact_id'),
+                      # deletes check whether a shared template is still in use
+                      db.Index('ix_events_template', 'template_id'),
+                      # repeating events waiting to be moved on to their next date
+                      db.Index('ix_events_recurring_done', 'id',
+                               postgresql_where=sqlalchemy.and_(job_done == True,
+                                                                recurrence != None)))
 
 
     def __repr__(self):
@@ -96,34 +176,171 @@ class ContactEvent(db.Model):
     __tablename__ = "contactsevents"
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    contact_id = db.Column(db.Integer, db.ForeignKey('contacts.id'), nullable=False)
-    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contacts.id', ondelete='CASCADE'), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id', ondelete='CASCADE'), nullable=False)
+    # the ON DELETE CASCADEs above look rows up by these
+    __table_args__ = (db.Index('ix_contactsevents_contact', 'contact_id'),
+                      db.Index('ix_contactsevents_event', 'event_id'))
+
+
+def template_digest(name, text):
+    """Content address of a template; migration 021 computes the same in SQL.
+    The name is length-prefixed so no two (name, text) pairs run together."""
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return hashlib.sha256(u"{}:{}{}".format(len(name), name, text).encode('utf-8')).hexdigest()
 
 
 class Template(db.Model):
-    """A template belongs to an event"""
+    """A message, stored once per distinct name and text and shared by every
+    event that sends it (see template_store.py)."""
 
     __tablename__ = "templates"
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
     text = db.Column(db.Text, nullable=False)
+    digest = db.Column(db.String(64), nullable=False, default=lambda context: template_digest(
+        context.current_parameters['name'], context.current_parameters['text']))
+    __table_args__ = (db.Index('ix_templates_digest', 'digest', unique=True),)
     
     def __repr__(self):
         """Provide better representation."""
         return "<Template id={} name={} text={}>".format(self.id, self.name, self.text)
 
 
+class Outbox(db.Model):
+    """One message (an event's email or SMS) waiting for a delivery worker."""
+
+    __tablename__ = "outbox"
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False) # 'contact' (day of) or 'reminder' (day before)
+    channel = db.Column(db.String(10), nullable=False) # 'email' or 'sms'
+    # pending -> claimed -> sent, or back to pending/failed on errors
+    status = db.Column(db.String(10), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    claimed_by = db.Column(db.String(64))
+    claimed_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.now, nullable=False)
+    event = db.relationship("Event", backref=db.backref("outbox"))
+    __table_args__ = (db.UniqueConstraint('event_id', 'kind', 'channel'),
+                      db.Index('ix_outbox_status', 'status', 'id'))
+
+    def __repr__(self):
+        """Provide better representation."""
+        return "<Outbox id={} event_id={} {}/{} status={}>".format(
+            self.id, self.event_id, self.kind, self.channel, self.status)
+
+
+
+class ImportJob(db.Model):
+    """A Facebook friend list waiting for (or going through) contact import."""
 
-def connect_to_db(app, uri='postgresql:///project'):
-    """Connect the database to our Flask app."""
+    __tablename__ = "import_jobs"
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # pending -> running -> done, or failed if the import itself blew up
+    status = db.Column(db.String(10), default='pending', nullable=False)
+    payload = db.Column(db.Text, nullable=False) # the contacts_list JSON as posted
+    total = db.Column(db.Integer, default=0, nullable=False)
+    processed = db.Column(db.Integer, default=0, nullable=False)
+    added = db.Column(db.Integer, default=0, nullable=False)
+    skipped = db.Column(db.Integer, default=0, nullable=False)
+    failures = db.Column(db.Text) # JSON list of rows that could not be imported
+    # the worker running it; refreshed every slice, so a stale claimed_at
+    # means that worker died
+    claimed_by = db.Column(db.String(64))
+    claimed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.now, nullable=False)
+    finished_at = db.Column(db.DateTime)
+    user = db.relationship("User", backref=db.backref("import_jobs"))
+    __table_args__ = (db.Index('ix_import_jobs_status', 'status', 'id'),)
+
+    def __repr__(self):
+        """Provide better representation."""
+        return "<ImportJob id={} user_id={} status={} {}/{}>".format(
+            self.id, self.user_id, self.status, self.processed, self.total)
+
+
+
+class EventHistory(db.Model):
+    """A sent event moved out of events by archive.py, with a copy of its
+    template so the templates row can go too."""
+
+    __tablename__ = "event_history"
+
+    # date is part of the key so the table can be partitioned by month
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False) # the event's id
+    date = db.Column(db.DateTime, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contacts.id', ondelete='CASCADE'),
+                           nullable=False)
+    template_name = db.Column(db.String(64), nullable=False)
+    template_text = db.Column(db.Text, nullable=False)
+    reminder_sent = db.Column(db.Boolean)
+    archived_at = db.Column(db.DateTime, default=datetime.datetime.now, nullable=False)
+    contact = db.relationship("Contact")
+    # the profile pages through a user's history by (date, id), newest first
+    __table_args__ = (db.Index('ix_event_history_user_date', 'user_id', 'date', 'id'),
+                      db.Index('ix_event_history_contact', 'contact_id'))
+
+    def __repr__(self):
+        """Provide better representation."""
+        return "<EventHistory id={} date={}>".format(self.id, self.date)
+
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def connect_to_db(app, uri=None, replica_uri=None, pool_size=None, max_overflow=None,
+                  pool_recycle=None, pool_timeout=None, pre_ping=None):
+    """Connect the database to our Flask app.
+
+    Anything not passed comes from the environment (DATABASE_URL,
+    DATABASE_REPLICA_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE,
+    DB_POOL_TIMEOUT, DB_PRE_PING); unset pool settings keep SQLAlchemy's
+    defaults. With a replica, reads inside replica() go there.
+    """
     # Configure to use our PstgreSQL database
-    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_DATABASE_URI'] = (uri or os.environ.get('DATABASE_URL')
+                                             or 'postgresql:///project')
+    replica_uri = replica_uri or os.environ.get('DATABASE_REPLICA_URL')
+    app.config['SQLALCHEMY_BINDS'] = {'replica': replica_uri} if replica_uri else None
+    app.config['SQLALCHEMY_POOL_SIZE'] = pool_size or _env_int('DB_POOL_SIZE')
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = (max_overflow if max_overflow is not None
+                                             else _env_int('DB_MAX_OVERFLOW'))
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = pool_recycle or _env_int('DB_POOL_RECYCLE')
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = pool_timeout or _env_int('DB_POOL_TIMEOUT')
+    app.config['SQLALCHEMY_POOL_PRE_PING'] = (pre_ping if pre_ping is not None
+                                              else bool(os.environ.get('DB_PRE_PING')))
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.app = app
     db.init_app(app)
 
 
+@contextmanager
+def replica():
+    """Send the session's queries to the read replica, if one is configured,
+    for the duration of the block. The replica may lag, so only use this
+    for reads that can tolerate slightly stale rows."""
+    session = db.session()
+    previous = session.info.get('replica')
+    session.info['replica'] = True
+    try:
+        yield
+    finally:
+        session.info['replica'] = previous
+
+
 if __name__ == "__main__":
     # from server import app
     app = Flask(__name__)
@@ -0,0 +1,128 @@
+"""Delivery worker: claims outbox rows and sends them.
+
+The scheduler (schedule_jobs.job with OUTBOX_DELIVERY set) only fills the
+outbox; run as many of these as you like, on as many hosts as you like:
+    python outbox_worker.py 4      # four worker processes
+
+Rows are claimed with FOR UPDATE SKIP LOCKED, so workers never block on or
+double-claim each other's rows. A claim that isn't finished within
+LEASE_SECONDS (the worker died) goes back up for grabs. Delivery is
+at-least-once: only a batch interrupted between its provider calls and its
+commit can be re-sent, so keep BATCH_SIZE small.
+"""
+from flask import Flask
+from functools import partial
+from model import Outbox, db, connect_to_db
+from delivery import DeliveryEngine, Message
+from recurrence import advance_sent
+from schedule_jobs import (contact_email, contact_text, reminder_email,
+                           reminder_text, send_text, deliver)
+import datetime, multiprocessing, os, socket, sys, time
+
+BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', 300))
+POLL_SECONDS = 5
+MAX_ATTEMPTS = 5
+
+# kind -> builder of that kind's message for an event
+EMAILS = {'contact': contact_email, 'reminder': reminder_email}
+TEXTS = {'contact': contact_text, 'reminder': reminder_text}
+
+# which Event flag a kind's rows complete
+FLAGS = {'contact': 'job_done', 'reminder': 'reminder_sent'}
+
+CLAIM_SQL = """
+    UPDATE outbox
+       SET status = 'claimed', claimed_by = :worker, claimed_at = now(),
+           attempts = attempts + 1
+     WHERE id IN (SELECT id FROM outbox
+                   WHERE status = 'pending'
+                      OR (status = 'claimed'
+                          AND claimed_at < now() - :lease * interval '1 second')
+                   ORDER BY id
+                   LIMIT :limit
+                   FOR UPDATE SKIP LOCKED)
+ RETURNING id"""
+
+# flip an event's flag once every row of that kind for it is settled: sent,
+# or failed for good after MAX_ATTEMPTS (a repeating event still has to move
+# on to its next occurrence when one channel can't be reached)
+FLAG_SQL = """
+    UPDATE events SET {flag} = true
+     WHERE id IN :event_ids
+       AND NOT EXISTS (SELECT 1 FROM outbox o
+                        WHERE o.event_id = events.id
+                          AND o.kind = :kind
+                          AND o.status NOT IN ('sent', 'failed'))"""
+
+
+def claim(worker_id, limit=BATCH_SIZE):
+    """Claims up to limit rows for worker_id; returns them as Outbox objects."""
+    result = db.session.execute(CLAIM_SQL, {'worker': worker_id,
+                                            'lease': LEASE_SECONDS,
+                                            'limit': limit})
+    ids = [row[0] for row in result]
+    db.session.commit()
+    if not ids:
+        return []
+    return Outbox.query.filter(Outbox.id.in_(ids)).order_by(Outbox.id).all()
+
+
+def process(rows, engine):
+    """Sends the claimed rows and records each outcome."""
+    emails, texts = [], []
+    for row in rows:
+        if row.channel == 'email':
+            emails.append(EMAILS[row.kind](row.event, key=row.id))
+        else:
+            texts.append(Message(row.id, 'sms', 'twilio',
+                                 partial(send_text, *TEXTS[row.kind](row.event))))
+    report = deliver(emails, texts, engine)
+
+    errors = dict((key, error) for key, _, error in report.failed)
+    for row in rows:
+        if row.id in errors:
+            row.last_error = str(errors[row.id])
+            row.status = 'failed' if row.attempts >= MAX_ATTEMPTS else 'pending'
+    sent_ids = [row.id for row in rows if row.id not in errors]
+    if sent_ids:
+        Outbox.query.filter(Outbox.id.in_(sent_ids)).update(
+            {'status': 'sent', 'sent_at': datetime.datetime.now()},
+            synchronize_session=False)
+    for kind, flag in FLAGS.items():
+        event_ids = tuple(set(row.event_id for row in rows if row.kind == kind))
+        if event_ids:
+            db.session.execute(FLAG_SQL.format(flag=flag),
+                               {'event_ids': event_ids, 'kind': kind})
+    db.session.commit()
+    print "{}: {}".format(rows[0].claimed_by, report)
+    # after the print: this drops the outbox rows of events it moves on
+    if any(row.kind == 'contact' for row in rows):
+        advance_sent()
+    return report
+
+
+def run(worker_id):
+    """Claim and send forever."""
+    app = Flask(__name__)
+    connect_to_db(app)
+    # pools are made here, not at import, so forked processes get live threads
+    engine = DeliveryEngine({'sendgrid': int(os.environ.get('SENDGRID_CONCURRENCY', 8)),
+                             'twilio': int(os.environ.get('TWILIO_CONCURRENCY', 8))})
+    while True:
+        rows = claim(worker_id)
+        if rows:
+            process(rows, engine)
+        else:
+            time.sleep(POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    host = socket.gethostname()
+    workers = [multiprocessing.Process(target=run, args=("{}:{}".format(host, i),))
+               for i in range(count)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
@@ -0,0 +1,63 @@
+"""Password hashing and checking.
+
+The algorithm and cost come from PASSWORD_METHOD (any werkzeug pbkdf2
+method, e.g. pbkdf2:sha256) and PASSWORD_ITERATIONS. Hashes record the
+parameters they were made with, so a login can tell when a stored hash is
+out of date and replace it.
+
+PBKDF2 is deliberately slow and holds the GIL, so the work runs on a small
+process pool (PASSWORD_WORKERS; 0 hashes in the calling thread) to keep a
+burst of logins from stalling every other request. Call start() before the
+process starts any threads: forking later copies whatever locks the other
+threads happen to hold into the workers.
+"""
+from werkzeug.security import generate_password_hash, check_password_hash
+import multiprocessing, os, threading
+
+METHOD = os.environ.get('PASSWORD_METHOD') or 'pbkdf2:sha256'
+ITERATIONS = int(os.environ.get('PASSWORD_ITERATIONS') or 50000)
+WORKERS = int(os.environ.get('PASSWORD_WORKERS') or 2)
+SALT_LENGTH = 16
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def current_method():
+    """werkzeug method string for new hashes, e.g. pbkdf2:sha256:50000."""
+    return "{}:{}".format(METHOD, ITERATIONS)
+
+
+def start():
+    """Fork the hashing workers, if they aren't running yet."""
+    global _pool
+    with _pool_lock:
+        if WORKERS and _pool is None:
+            _pool = multiprocessing.Pool(WORKERS)
+
+
+def _run(fn, *args):
+    if not WORKERS:
+        return fn(*args)
+    if _pool is None:
+        # scripts that never called start(); the lock keeps it to one pool
+        start()
+    return _pool.apply(fn, args)
+
+
+def hash_password(password):
+    """Hash password with the configured method and cost."""
+    return _run(generate_password_hash, password, current_method(), SALT_LENGTH)
+
+
+def needs_rehash(stored):
+    """True if stored was made with other parameters than current_method()."""
+    return stored.split('$', 1)[0] != current_method()
+
+
+def verify(stored, password):
+    """Returns (password matches, stored hash should be replaced)."""
+    if not stored or not password:
+        return False, False
+    ok = _run(check_password_hash, stored, password)
+    return ok, ok and needs_rehash(stored)
@@ -0,0 +1,29 @@
+"""Phone number normalization to E.164 (+<country code><number>).
+
+Numbers without a leading + or 00 are taken to be in DEFAULT_COUNTRY_CODE
+(North America unless configured), which is how users have typed them so
+far. Migration 012 applies the same rules in SQL to backfill old rows.
+"""
+import os, re
+
+DEFAULT_COUNTRY_CODE = os.environ.get('DEFAULT_COUNTRY_CODE') or '1'
+
+
+def to_e164(raw):
+    """'(123) 456-7890' -> '+11234567890'; None if raw isn't a usable number."""
+    if not raw:
+        return None
+    raw = raw.strip()
+    digits = re.sub(r'\D', '', raw)
+    if raw.startswith('+'):
+        number = digits
+    elif raw.startswith('00'):
+        number = digits[2:]
+    elif DEFAULT_COUNTRY_CODE == '1' and len(digits) == 11 and digits.startswith('1'):
+        number = digits
+    else:
+        number = DEFAULT_COUNTRY_CODE + digits
+    # E.164 allows at most 15 digits; anything under 8 isn't a real number
+    if not 8 <= len(number) <= 15 or number.startswith('0'):
+        return None
+    return '+' + number
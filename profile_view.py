@@ -0,0 +1,145 @@
+"""Everything the /profile page shows, loaded up front a page at a time.
+
+test.html used to walk user.events, user.contacts, contact.events and
+event.template lazily, which cost a SELECT per contact and per event. The
+page is now built from a fixed number of queries, and only the first
+PAGE_SIZE contacts and queued events are rendered; /api/contacts and
+/api/events serve the rest as the user scrolls.
+
+Pages are keyset-paginated on (name, id) for contacts and (date, id) for
+events, so a late page costs the same as the first one.
+
+Archived events (see archive.py) aren't part of the page; /api/history
+serves them, newest first, when the user asks for them.
+"""
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
+from model import Contact, Event, EventHistory, User
+import base64, datetime, json
+
+PAGE_SIZE = 50
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    """Opaque token for the last row of a page."""
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor, parse_key):
+    """Inverse of encode_cursor for a [sort key, id] cursor: (parse_key(key),
+    id), or None for a missing, garbled or wrong-shaped cursor."""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if not isinstance(values, list) or len(values) != 2:
+            return None
+        key, id = values
+        if not isinstance(id, (int, long)) or isinstance(id, bool):
+            return None
+        return parse_key(key), id
+    except (TypeError, ValueError):
+        return None
+
+
+def _name_key(value):
+    if not isinstance(value, basestring):
+        raise TypeError("contact cursor key must be a name")
+    return value
+
+
+def _date_key(value):
+    return datetime.datetime.strptime(value, DATE_FORMAT)
+
+
+class ProfileView(object):
+    """The user, a page of contacts (by name) with each contact's events (by
+    date), and a page of queued events."""
+
+    def __init__(self, user, contacts, events, upcoming, next_contacts=None,
+                 next_events=None):
+        self.user = user
+        self.contacts = contacts
+        self.events_by_contact = {}
+        for event in events:
+            self.events_by_contact.setdefault(event.contact_id, []).append(event)
+        self.upcoming = upcoming        # (event, contact) still to be sent, by date
+        self.next_contacts = next_contacts
+        self.next_events = next_events
+
+    def events_for(self, contact):
+        return self.events_by_contact.get(contact.id, [])
+
+
+def contacts_page(user_id, cursor=None, limit=None):
+    """One page of contacts and all of their events; returns
+    (contacts, events, next cursor or None)."""
+    limit = limit or PAGE_SIZE
+    query = Contact.query.filter(Contact.user_id == user_id)
+    after = decode_cursor(cursor, _name_key)
+    if after:
+        query = query.filter(tuple_(Contact.name, Contact.id) > tuple_(*after))
+    contacts = query.order_by(Contact.name, Contact.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(contacts) > limit:
+        contacts = contacts[:limit]
+        next_cursor = encode_cursor([contacts[-1].name, contacts[-1].id])
+    events = []
+    if contacts:
+        # one row per event either way, so a join is cheaper than a second
+        # round trip
+        events = (Event.query.filter(Event.contact_id.in_([c.id for c in contacts]))
+                  .options(joinedload(Event.template))
+                  .order_by(Event.date, Event.id).all())
+    return contacts, events, next_cursor
+
+
+def events_page(user_id, cursor=None, limit=None):
+    """One page of the user's queued events as (event, contact) pairs;
+    returns (pairs, next cursor or None)."""
+    limit = limit or PAGE_SIZE
+    query = (Event.query.filter(Event.user_id == user_id, Event.job_done == False)
+             .join(Contact, Contact.id == Event.contact_id)
+             .add_entity(Contact)
+             .options(joinedload(Event.template)))
+    after = decode_cursor(cursor, _date_key)
+    if after:
+        query = query.filter(tuple_(Event.date, Event.id) > tuple_(*after))
+    pairs = query.order_by(Event.date, Event.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(pairs) > limit:
+        pairs = pairs[:limit]
+        last = pairs[-1][0]
+        next_cursor = encode_cursor([last.date.strftime(DATE_FORMAT), last.id])
+    return pairs, next_cursor
+
+
+def history_page(user_id, cursor=None, limit=None):
+    """One page of the user's archived events, newest first, as
+    (history, contact) pairs; returns (pairs, next cursor or None)."""
+    limit = limit or PAGE_SIZE
+    query = (EventHistory.query.filter(EventHistory.user_id == user_id)
+             .join(Contact, Contact.id == EventHistory.contact_id)
+             .add_entity(Contact))
+    after = decode_cursor(cursor, _date_key)
+    if after:
+        query = query.filter(tuple_(EventHistory.date, EventHistory.id) < tuple_(*after))
+    pairs = (query.order_by(EventHistory.date.desc(), EventHistory.id.desc())
+             .limit(limit + 1).all())
+    next_cursor = None
+    if len(pairs) > limit:
+        pairs = pairs[:limit]
+        last = pairs[-1][0]
+        next_cursor = encode_cursor([last.date.strftime(DATE_FORMAT), last.id])
+    return pairs, next_cursor
+
+
+def load_profile(user_id, limit=None, user=None):
+    """Returns the first page of a ProfileView, or None if there is no such user."""
+    user = user or User.query.get(user_id)
+    if user is None:
+        return None
+    contacts, events, next_contacts = contacts_page(user_id, limit=limit)
+    upcoming, next_events = events_page(user_id, limit=limit)
+    return ProfileView(user, contacts, events, upcoming, next_contacts, next_events)
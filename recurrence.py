@@ -0,0 +1,67 @@
+"""Repeating events (birthdays, anniversaries, monthly check-ins).
+
+A repeating event is one events row whose date is always its *next*
+occurrence, so the scheduler's scans on ix_events_due treat it exactly
+like a one-off event. Once its day-of send is done (job_done set), it is
+moved forward instead of staying done: date becomes the next occurrence,
+both flags are cleared and its outbox rows are dropped so the next round
+can be queued again. No new rows per year, just one per contact.
+
+Occurrences are counted from recurs_from, the first date, so a monthly
+event on the 31st comes back on the 31st after a short month, and a
+yearly one on Feb 29 falls on Feb 28 in other years.
+"""
+from model import Event, Outbox, db
+import calendar, datetime
+
+RULES = ('yearly', 'monthly', 'daily')
+
+
+def add_months(date, months):
+    """date moved by months, clamped to the end of shorter months."""
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    return date.replace(year=year, month=month,
+                        day=min(date.day, calendar.monthrange(year, month)[1]))
+
+
+def next_occurrence(rule, every, start, after):
+    """First occurrence of rule (every `every` years/months/days from start)
+    later than after."""
+    if rule == 'daily':
+        step = datetime.timedelta(days=every)
+        return start + step * max(1, (after - start).days // every + 1)
+    months = every * (12 if rule == 'yearly' else 1)
+    k = max(1, ((after.year - start.year) * 12 + after.month - start.month) // months)
+    date = add_months(start, k * months)
+    while date <= after:
+        k += 1
+        date = add_months(start, k * months)
+    return date
+
+
+def advance_sent(now=None):
+    """Moves every repeating event whose day-of send is finished on to its
+    next occurrence; returns how many moved.
+
+    Events with outbox rows still pending or claimed (failed channels
+    being retried) wait until those are settled. Occurrences missed while
+    nothing was running are skipped rather than sent late.
+    """
+    now = now or datetime.datetime.now()
+    today = datetime.datetime(now.year, now.month, now.day)
+    unsettled = db.session.query(Outbox.event_id).filter(
+        Outbox.event_id == Event.id, Outbox.status.in_(['pending', 'claimed']))
+    events = Event.query.filter(Event.job_done == True, Event.recurrence != None,
+                                ~unsettled.exists()).all()
+    for event in events:
+        event.date = next_occurrence(event.recurrence, event.recur_every or 1,
+                                     event.recurs_from or event.date, max(event.date, today))
+        event.job_done = False
+        event.reminder_sent = False
+    if events:
+        Outbox.query.filter(Outbox.event_id.in_([e.id for e in events])).delete(
+            synchronize_session=False)
+    db.session.commit()
+    return len(events)
@@ -0,0 +1,53 @@
+"""Set-based deletes for events and contacts.
+
+contactsevents and outbox rows go with their event, and events with their
+contact, through ON DELETE CASCADE. Templates are shared between events
+(see template_store.py) and referenced *by* them, so a cascade can't reach
+them; each delete below removes the events in a data-modifying CTE and, in
+the same statement, the templates that only those events used.
+"""
+from model import db
+from template_store import ORPHANS_SQL
+
+DELETE_EVENTS_SQL = """
+WITH gone AS (
+    DELETE FROM events WHERE user_id = :user_id AND id = ANY(:ids)
+    RETURNING id, template_id
+), templates_gone AS (
+    DELETE FROM templates WHERE id IN (%s)
+)
+SELECT count(*) FROM gone
+""" % ORPHANS_SQL.format(gone='gone')
+
+DELETE_CONTACTS_SQL = """
+WITH contacts_gone AS (
+    DELETE FROM contacts WHERE user_id = :user_id AND id = ANY(:ids)
+    RETURNING id
+), events_gone AS (
+    DELETE FROM events WHERE contact_id IN (SELECT id FROM contacts_gone)
+    RETURNING id, template_id
+), templates_gone AS (
+    DELETE FROM templates WHERE id IN (%s)
+)
+SELECT count(*) FROM contacts_gone
+""" % ORPHANS_SQL.format(gone='events_gone')
+
+
+def delete_events(user_id, event_ids):
+    """Delete user_id's events (and templates nothing else uses) in one
+    statement; returns how many events were deleted."""
+    result = db.session.execute(DELETE_EVENTS_SQL,
+                                {'user_id': user_id, 'ids': [int(i) for i in event_ids]})
+    deleted = result.scalar()
+    db.session.commit()
+    return deleted
+
+
+def delete_contacts(user_id, contact_ids):
+    """Delete user_id's contacts with their events, and templates nothing
+    else uses, in one statement; returns how many contacts were deleted."""
+    result = db.session.execute(DELETE_CONTACTS_SQL,
+                                {'user_id': user_id, 'ids': [int(i) for i in contact_ids]})
+    deleted = result.scalar()
+    db.session.commit()
+    return deleted
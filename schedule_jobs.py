@@ -1,13 +1,17 @@
-from model import User, Event, ContactEvent, Contact, Template, db, connect_to_db
+from model import User, Event, ContactEvent, Contact, Template, Outbox, db, connect_to_db, replica
+from delivery import DeliveryEngine, Message
+from recurrence import advance_sent
 from flask import Flask
+from functools import partial
+from sqlalchemy import func
+import metrics, threading, pytz
 
 # SendGrid Emailing
-import os, time, json, datetime, schedule, sendgrid
-from sendgrid.helpers.mail import *
+import os, time, json, datetime
+from email_backend import OutgoingEmail, SendGridBatcher
 
 # Twilio Texting
-from twilio.twiml.messaging_response import MessagingResponse
-from twilio.rest import Client
+from sms_transport import SmsTransport
 
 # Source secrets and create client
 account = os.environ.get('TWILIO_TEST_ACCOUNT')
@@ -16,18 +20,91 @@ twilio_num = os.environ.get('TWILIO_NUMBER')
 my_num = os.environ.get('MY_NUMBER')
 my_email = os.environ.get('MY_EMAIL')
 kit_email = os.environ.get('KIT_EMAIL')
-client = Client(account, token)
+# One SendGrid client for the process; SENDGRID_HOST can point at a stub
+mailer = SendGridBatcher(os.environ.get('SENDGRID_API_KEY'),
+                         host=os.environ.get('SENDGRID_HOST', 'https://api.sendgrid.com'))
+
+# The Twilio transport and the delivery engine run worker threads, so they
+# are made on first use (get_sms, get_delivery), not at import: server.py
+# and outbox_worker.py fork their worker processes after importing this
+sms = None
+delivery = None
+_providers_lock = threading.Lock()
+
+# Hourly dispatch: the local hour users' messages go out, and which slice of
+# users (user_id % SHARD_COUNT == SHARD_INDEX) this scheduler handles
+SEND_HOUR = int(os.environ.get('SEND_HOUR', 0))
+SHARD = (int(os.environ.get('SHARD_INDEX', 0)), int(os.environ.get('SHARD_COUNT', 1)))
+HOURLY_DISPATCH = os.environ.get('DISPATCH_MODE') == 'hourly'
+
+# Histogram of time spent in each scheduler stage
+STAGE = 'scheduler_stage_seconds'
+
+# Event ids per bulk status UPDATE
+STATUS_CHUNK = 1000
+
+# Reminders go out this long before the event's day
+REMINDER_OFFSET = datetime.timedelta(days=int(os.environ.get('REMINDER_DAYS_BEFORE', 1)))
 
 app = Flask(__name__)
 
+def get_sms():
+    """The process' pooled Twilio transport (also used by server.py's /sms
+    handler); TWILIO_BASE_URL can point at a local fake."""
+    global sms
+    with _providers_lock:
+        if sms is None:
+            sms = SmsTransport(account, token, twilio_num,
+                               pool_size=int(os.environ.get('TWILIO_POOL_SIZE', 8)),
+                               base_url=os.environ.get('TWILIO_BASE_URL'))
+    return sms
+
+
+def get_delivery():
+    """The process' DeliveryEngine: how many requests each provider may have
+    in flight at once."""
+    global delivery
+    with _providers_lock:
+        if delivery is None:
+            delivery = DeliveryEngine({
+                'sendgrid': int(os.environ.get('SENDGRID_CONCURRENCY', 8)),
+                'twilio': int(os.environ.get('TWILIO_CONCURRENCY', 8))})
+    return delivery
+
 ##### SCHEDULING ######
 
+def day_range(day):
+    """Returns (start, end) datetimes for the half-open range [day, day+1)."""
+    start = datetime.datetime(day.year, day.month, day.day, 0, 0)
+    return start, start + datetime.timedelta(days=1)
+
+
+def return_due_events(day, flag, timezones=None, shard=(0, 1)):
+    """Returns events dated on day whose flag (Event.job_done or
+    Event.reminder_sent) is still False.
+
+    Matches on a range instead of exact midnight so ix_events_due
+    (date, job_done, reminder_sent) covers the whole scan. timezones limits
+    it to users in those zones; shard (index, count) to user ids with
+    user_id % count == index.
+    """
+    start, end = day_range(day)
+    with metrics.timer(STAGE, job='return_due_events', stage='query'):
+        query = Event.query.filter(Event.date >= start,
+                                   Event.date < end,
+                                   flag == False)
+        if timezones is not None:
+            query = query.join(User, User.id == Event.user_id).filter(
+                User.timezone.in_(timezones))
+        index, count = shard
+        if count > 1:
+            query = query.filter(Event.user_id % count == index)
+        return query.order_by(Event.id).all()
+
+
 def return_todays_events():
     """Checks if there are any events today."""
-    t = datetime.datetime.now()
-    # Get today's date -- YYYY, MM, DD only to match DB format
-    today = datetime.datetime(t.year, t.month, t.day, 0, 0)
-    todays_events = Event.query.filter(Event.date == today).all()
+    todays_events = return_due_events(datetime.datetime.now(), Event.job_done)
     if todays_events == []:
         return "No events!"
     else:
@@ -35,32 +112,143 @@ def return_todays_events():
 
 
 def return_tmrws_events():
-    """Checks if there are any events today."""
-    t = datetime.datetime.now()
-    if t.month == 11 and t.day+1 == 31:
-        tmrw = datetime.datetime(t.year, 12, 1, 0, 0)
-    else:
-    # Get tomorrow's date -- YYYY, MM, DD only to match DB format
-        tmrw = datetime.datetime(t.year, t.month, t.day + 1, 0, 0)
-    # Fetch tomorrow's events
-    events = Event.query.filter(Event.date == tmrw).all()
+    """Checks if there are any events tomorrow."""
+    tmrw = datetime.datetime.now() + REMINDER_OFFSET
+    events = return_due_events(tmrw, Event.reminder_sent)
     if events == []:
         return "No events!"
     else:
         return events
 
 
+# Outbox rows each due event needs: (kind, channel, extra join/filter)
+OUTBOX_FILLS = [
+    ('contact', 'email', "JOIN contacts c ON c.id = e.contact_id",
+     "NOT e.job_done AND coalesce(c.email, '') <> ''"),
+    ('contact', 'sms', "JOIN contacts c ON c.id = e.contact_id",
+     "NOT e.job_done AND coalesce(c.phone, '') <> ''"),
+    ('reminder', 'email', "", "NOT e.reminder_sent"),
+    ('reminder', 'sms', "JOIN users u ON u.id = e.user_id",
+     "NOT e.reminder_sent AND coalesce(u.phone, '') <> ''"),
+]
+
+# today's events the fills above gave no contact rows (their contact has
+# neither an email nor a phone): nothing will ever send them, so they are
+# done now, as direct mode does
+NOTHING_TO_SEND_SQL = """
+    UPDATE events e SET job_done = true
+     WHERE e.date >= :start AND e.date < :end AND NOT e.job_done
+       AND NOT EXISTS (SELECT 1 FROM outbox o
+                        WHERE o.event_id = e.id AND o.kind = 'contact')"""
+
+
+def enqueue_due_events(now=None):
+    """Adds outbox rows for today's sends and tomorrow's reminders.
+
+    Runs as plain INSERT ... SELECT so nothing is loaded into Python, and
+    ON CONFLICT makes it safe to run as often as the scheduler likes. Events
+    with no channel to send on are marked done instead.
+    """
+    now = now or datetime.datetime.now()
+    days = {'contact': day_range(now),
+            'reminder': day_range(now + REMINDER_OFFSET)}
+    for kind, channel, join, where in OUTBOX_FILLS:
+        start, end = days[kind]
+        db.session.execute(
+            "INSERT INTO outbox (event_id, kind, channel, status, attempts, created_at) "
+            "SELECT e.id, :kind, :channel, 'pending', 0, now() FROM events e {} "
+            "WHERE e.date >= :start AND e.date < :end AND {} "
+            "ON CONFLICT (event_id, kind, channel) DO NOTHING".format(join, where),
+            {'kind': kind, 'channel': channel, 'start': start, 'end': end})
+    start, end = days['contact']
+    undeliverable = db.session.execute(NOTHING_TO_SEND_SQL,
+                                       {'start': start, 'end': end}).rowcount
+    db.session.commit()
+    if undeliverable:
+        advance_sent()
+
+
+def mark_events(event_ids, flag):
+    """Sets flag ('job_done' or 'reminder_sent') on every event in event_ids
+    with one UPDATE ... WHERE id IN (...) per STATUS_CHUNK ids, and commits
+    once. Repeating events that are done move on to their next date."""
+    event_ids = list(event_ids)
+    for i in range(0, len(event_ids), STATUS_CHUNK):
+        chunk = event_ids[i:i + STATUS_CHUNK]
+        Event.query.filter(Event.id.in_(chunk)).update({flag: True},
+                                                       synchronize_session=False)
+    db.session.commit()
+    if flag == 'job_done':
+        advance_sent()
+
+
+def record_failures(report, kind):
+    """Queues a Report's failed (event id, channel) sends as pending outbox
+    rows, so they are retried without re-sending the channels that worked."""
+    rows = [{'event_id': key, 'kind': kind, 'channel': channel, 'error': str(error)}
+            for key, channel, error in report.failed]
+    if rows:
+        db.session.execute(
+            "INSERT INTO outbox (event_id, kind, channel, status, attempts, last_error, created_at) "
+            "VALUES (:event_id, :kind, :channel, 'pending', 1, :error, now()) "
+            "ON CONFLICT (event_id, kind, channel) DO NOTHING", rows)
+
+
+def retry_failed():
+    """Re-sends one batch of pending outbox rows (direct mode has no workers
+    to do it)."""
+    from outbox_worker import claim, process
+    if not Outbox.query.filter(Outbox.status == 'pending').first():
+        return
+    rows = claim('scheduler')
+    if rows:
+        process(rows, get_delivery())
+
+
+def deliver(emails, texts, engine=None):
+    """Sends OutgoingEmails in batches alongside the text Messages; returns
+    one Report for both. Each batch (one sender's emails) is its own task on
+    the sendgrid pool, so up to SENDGRID_CONCURRENCY go out at once."""
+    engine = engine or get_delivery()
+    start = time.time()
+    batches = [(group, engine.pools['sendgrid'].submit(mailer.send_batch, sender, group))
+               for sender, group in mailer.batches(emails)]
+    report = engine.deliver(texts)
+    for group, pending in batches:
+        try:
+            report.extend(pending.result())
+        except Exception as e:
+            print "FAILED email batch of {}: {}".format(len(group), e)
+            report.failed.extend((email.key, 'email', e) for email in group)
+    report.elapsed = time.time() - start
+    for _, channel in report.sent:
+        metrics.inc('messages_sent_total', channel=channel)
+    for _, channel, _ in report.failed:
+        metrics.inc('messages_failed_total', channel=channel)
+    return report
+
+
 def send_all_emails(events):
     """ Takes a list of today's events (Event objects); emails contacts"""
     if events == [] or events == "No events!":
         return "No events today"
-    for event in events:
-        if event.job_done == False:
-            send_email(event)
-            text_contact(event)
-            # change job_done to True
-            event.job_done = True
-            db.session.commit()
+    events = [event for event in events if event.job_done == False]
+    emails, texts = [], []
+    with metrics.timer(STAGE, job='send_all_emails', stage='render'):
+        for event in events:
+            if event.contacts[0].email:
+                emails.append(contact_email(event))
+            if event.contacts[0].phone:
+                texts.append(Message(event.id, 'sms', 'twilio',
+                                     partial(send_text, *contact_text(event))))
+    with metrics.timer(STAGE, job='send_all_emails', stage='deliver'):
+        report = deliver(emails, texts)
+    # failed channels are retried from the outbox, so every event is done here
+    with metrics.timer(STAGE, job='send_all_emails', stage='commit'):
+        record_failures(report, 'contact')
+        mark_events([event.id for event in events], 'job_done')
+    print "CONTACTS: {}".format(report)
+    return report
 
 
 def remind_all_users(events):
@@ -69,104 +257,221 @@ def remind_all_users(events):
     """
     if events == [] or events == "No events!":
         return "No events today"
-    for event in events:
-        if event.reminder_sent == False:
-            text_reminder(event)
-            remind_user(event)
-            # change reminder_sent to True
-            event.reminder_sent = True
-            db.session.commit()
+    events = [event for event in events if event.reminder_sent == False]
+    emails, texts = [], []
+    with metrics.timer(STAGE, job='remind_all_users', stage='render'):
+        for event in events:
+            if event.user.phone:
+                texts.append(Message(event.id, 'sms', 'twilio',
+                                     partial(send_text, *reminder_text(event))))
+            emails.append(reminder_email(event))
+    with metrics.timer(STAGE, job='remind_all_users', stage='deliver'):
+        report = deliver(emails, texts)
+    # failed channels are retried from the outbox, so every event is done here
+    with metrics.timer(STAGE, job='remind_all_users', stage='commit'):
+        record_failures(report, 'reminder')
+        mark_events([event.id for event in events], 'reminder_sent')
+    print "REMINDERS: {}".format(report)
+    return report
 
 
-def text_reminder(event):
-    """Text reminder to user of an event; asks if they want to update msg"""
+##### MESSAGE CONTENTS (read from the DB on the scheduler thread) ######
+
+def reminder_text(event):
+    """Returns (to, body) of the SMS reminding the user of an event."""
     user_phone = event.contacts[0].user.phone
     user_fname = event.contacts[0].user.fname
     contact_name = event.contacts[0].name
-    # Send an SMS
     my_msg = "\n\n\nHello {}, your event's coming up tomorrow for: {}. "\
             "\n\n--------\n\nYour message currently is:\n\n\n'{}'\n\n--------\n\n "\
             "If you'd like to update this message, please reply with your new message "\
             "(in one SMS response, with 'event_id={}' at the end)".format(user_fname, contact_name.encode('utf-8'), event.template.text.encode('utf-8'), event.id)
-    print user_phone
-    message = client.messages.create(to=user_phone, from_=twilio_num, body=my_msg)
-    print "TEXTED REMINDER TO USER: {}".format(user_phone)
+    return user_phone, my_msg
 
 
+def contact_text(event):
+    """Returns (to, body) of the SMS sent to the contact on the day."""
+    return event.contacts[0].phone, event.template.text
 
-def text_contact(event):
+
+def contact_email(event, key=None):
+    """Returns the email sent to the contact on the day, on behalf of the
+    user. key defaults to the event id."""
+    return OutgoingEmail(key=key or event.id,
+                         from_email=event.contacts[0].user.email,
+                         from_name=event.contacts[0].user.fname,
+                         to_email=event.contacts[0].email,
+                         to_name=event.contacts[0].name.encode('utf-8'),
+                         subject=event.template.name,
+                         body=event.template.text.encode('utf-8'))
+
+
+def reminder_email(event, key=None):
+    """Returns the email reminding the user of an event coming up. key
+    defaults to the event id."""
+    subject = 'YO, double-check this: {} message'.format(event.template.name)
+    email_body = "Just wanted to remind you that we'll send this out soon. Let us if you want to make edits: \n{}".format(event.template.text.encode('utf-8'))
+    return OutgoingEmail(key=key or event.id,
+                         from_email=kit_email,
+                         from_name="Keep in Touch Team",
+                         to_email=event.user.email,
+                         to_name=event.user.fname,
+                         subject=subject,
+                         body=email_body)
+
+
+##### PROVIDER CALLS (safe to run on delivery worker threads) ######
+
+def send_text(to, body):
+    """Send one SMS through Twilio."""
+    message = get_sms().send(to, body)
+    print "TEXTED: {}".format(to)
+    return message
+
+
+def send_mails(emails):
+    """Send OutgoingEmails through SendGrid; raise if any wasn't accepted."""
+    report = mailer.send(emails)
+    if report.failed:
+        raise report.failed[0][2]
+    return report
+
+
+def text_reminder(event):
     """Text reminder to user of an event; asks if they want to update msg"""
-    contact_phone = event.contacts[0].phone
-    contact_name = event.contacts[0].name
-    template_text = event.template.text
-    # Send an SMS
-    my_msg = template_text
-    message = client.messages.create(to=contact_phone, from_=twilio_num, body=my_msg)
-    print "TEXTED CONTACT: {}".format(contact_phone)
+    send_text(*reminder_text(event))
 
 
+def text_contact(event):
+    """Text contact on day of event on behalf of the user."""
+    send_text(*contact_text(event))
+
 
 def send_email(event):
     """Email contact on day of event on behalf of the user."""
-    message = Mail()
-    sg = sendgrid.SendGridAPIClient(apikey=os.environ.get('SENDGRID_API_KEY'))
-    # Create from_email object from event object arg (the user)
-    from_address = event.contacts[0].user.email
-    from_name = event.contacts[0].user.fname
-    from_email = Email(from_address, from_name)
-    # Create to_email object from event object arg (the user's contact)
-    to_address = event.contacts[0].email
-    to_name = event.contacts[0].name.encode('utf-8')
-    to_email = Email(to_address, to_name)
-    # Create mail object from event object arg
-    email_body = event.template.text.encode('utf-8')
-    subject = event.template.name
-    content = Content("text/plain", email_body)
-    print 
-    mail = Mail(from_email, subject, to_email, content)
-    # Send email, print confirmation/status
-    response = sg.client.mail.send.post(request_body=mail.get())
-    print "CONTACT EMAILED"
-    print(response.status_code)
-    print(response.body)
-    print(response.headers)
+    send_mails([contact_email(event)])
 
 
 def remind_user(event):
     """Email user of event coming up."""
-    message = Mail()
-    sg = sendgrid.SendGridAPIClient(apikey=os.environ.get('SENDGRID_API_KEY'))
-    # Create from_email object from event object arg
-    from_email = Email(kit_email, "Keep in Touch Team")
-    # Create to email property from event object arg (the user)
-    to_address = event.user.email
-    to_name = event.user.fname
-    to_email = Email(to_address, to_name)
-    # Create mail to be sent (reminder email)
-    subject = 'YO, double-check this: {} message'.format(event.template.name)
-    email_body = "Just wanted to remind you that we'll send this out soon. Let us if you want to make edits: \n{}".format(event.template.text.encode('utf-8'))
-    content = Content("text/plain", email_body)
-    mail = Mail(from_email, subject, to_email, content)
-    # Send reminder email and print confirmation/status
-    response = sg.client.mail.send.post(request_body=mail.get())
-    print "REMINDER EMAIL SENT TO USER"
-    print(response.status_code)
-    print(response.body)
-    print(response.headers)
+    send_mails([reminder_email(event)])
 
 # Set the schedule's job list
 def job():
     """Schedule job instance"""
+    metrics.inc('scheduler_runs_total')
+    if os.environ.get('OUTBOX_DELIVERY'):
+        # outbox_worker.py processes do the sending
+        enqueue_due_events()
+        return
     today_events = return_todays_events()
     send_all_emails(today_events)
     tmrw_events = return_tmrws_events()
     remind_all_users(tmrw_events)
+    retry_failed()
+
+def zones_due(now_utc, offset=datetime.timedelta(0), from_replica=False):
+    """Groups the users' timezones whose local SEND_HOUR has arrived today by
+    their local date (plus offset). Zones past the hour stay due for the rest
+    of their day, so a missed hourly run is caught up by the next one.
+    from_replica reads the zones from the read replica, which may lag."""
+    days = {}
+    if from_replica:
+        with replica():
+            zones = db.session.query(User.timezone).distinct().all()
+    else:
+        zones = db.session.query(User.timezone).distinct().all()
+    for (zone,) in zones:
+        try:
+            local = pytz.utc.localize(now_utc).astimezone(pytz.timezone(zone))
+        except pytz.UnknownTimeZoneError:
+            print "UNKNOWN TIMEZONE: {}".format(zone)
+            continue
+        if local.hour >= SEND_HOUR:
+            day = datetime.datetime(local.year, local.month, local.day) + offset
+            days.setdefault(day, []).append(zone)
+    return days
+
+
+def hourly_job(now_utc=None, shard=SHARD, from_replica=False):
+    """Sends for the users in this shard whose local send time has arrived.
+    from_replica reads the due zones from the read replica."""
+    now_utc = now_utc or datetime.datetime.utcnow()
+    for day, zones in zones_due(now_utc, from_replica=from_replica).items():
+        send_all_emails(return_due_events(day, Event.job_done, zones, shard))
+    for day, zones in zones_due(now_utc, REMINDER_OFFSET, from_replica).items():
+        remind_all_users(return_due_events(day, Event.reminder_sent, zones, shard))
+    retry_failed()
+
+
+# Routes that add or move events set this so the scheduler re-plans its sleep
+wake = threading.Event()
+# Longest the scheduler sleeps without re-checking (covers other processes'
+# edits, which can't set wake)
+MAX_SLEEP_SECONDS = 3600
+# Pause after a run before re-checking, so failed sends don't spin
+RETRY_SECONDS = 60
+
+
+def wake_scheduler():
+    """Tell the scheduler thread an event changed; it re-plans right away."""
+    wake.set()
+
+
+def next_due_time(now=None):
+    """Returns when job() next has work to do (now, if something is due)."""
+    now = now or datetime.datetime.now()
+    today, _ = day_range(now)
+    # reads the primary: it runs right after wake_scheduler(), when the event
+    # that is due may not have reached a replica yet
+    send_day = db.session.query(func.min(Event.date)).filter(
+        Event.date >= today, Event.job_done == False).scalar()
+    remind_day = db.session.query(func.min(Event.date)).filter(
+        Event.date >= today + REMINDER_OFFSET, Event.reminder_sent == False).scalar()
+    due = []
+    if Outbox.query.filter(Outbox.status == 'pending').first():
+        due.append(now)
+    if send_day:
+        due.append(day_range(send_day)[0])
+    if remind_day:
+        due.append(day_range(remind_day)[0] - REMINDER_OFFSET)
+    if not due:
+        return None
+    return max(min(due), now)
+
+
+def run_hourly():
+    """Run hourly_job() at the top of every hour, and whenever woken."""
+    woken = False
+    while True:
+        wake.clear()
+        # a wake means a write just committed, which a replica may not have yet
+        hourly_job(from_replica=not woken)
+        db.session.remove()
+        now = datetime.datetime.now()
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        woken = wake.wait((next_hour - now).total_seconds())
+
 
 def schedule1():
-    # schedule.every().day.at("00:00").do(job) # Check every day at midnight (for real app)
-    schedule.every(2).seconds.do(job)  # Testing/demo purposes
+    """Run job() whenever something is due; sleep (not spin) in between.
+    With DISPATCH_MODE=hourly, dispatch by users' timezones instead."""
+    if HOURLY_DISPATCH:
+        return run_hourly()
     while True:
-        schedule.run_pending()
+        wake.clear()
+        now = datetime.datetime.now()
+        due = next_due_time(now)
+        db.session.remove()
+        if due is None or due > now:
+            delay = MAX_SLEEP_SECONDS
+            if due is not None:
+                delay = min(delay, (due - now).total_seconds())
+            wake.wait(delay)
+            continue
+        job()
+        db.session.remove()
+        wake.wait(RETRY_SECONDS)
 
 
 if __name__ == "__main__": 
@@ -1,5 +1,7 @@
 from sqlalchemy import func
 from model import User, Event, ContactEvent, Contact, Template, db, connect_to_db
+from passwords import hash_password
+from template_store import intern
 import datetime
 import os
 
@@ -11,8 +13,8 @@ def example_data():
     fb_uid = os.environ.get('FB_UID')
 
 # ADD USERS
-    jane = User(email='j@gmail.com', password='a', fname='Jane', lname='Hacks', phone='+11234567890')
-    bob = User(email='h@gmail.com', password='a', fname='Bob', lname='Baller', phone='+10987654321')
+    jane = User(email='j@gmail.com', password=hash_password('a'), fname='Jane', lname='Hacks', phone='+11234567890')
+    bob = User(email='h@gmail.com', password=hash_password('a'), fname='Bob', lname='Baller', phone='+10987654321')
     db.session.add_all([jane, bob])
     # db.session.add(inny)
     db.session.commit()
@@ -22,18 +24,17 @@ def example_data():
     ian = Contact(name='Ian Interviewer', email='i@gmail.com', user_id=bob.id)
     db.session.add_all([john, sally, ian])
     db.session.commit()
-    # ADD TEMPLATES
-    fup = Template(name='follow up', text='hello there')
-    ty = Template(name='thank you', text='thank you for meeting!')
-    ty2 = Template(name='thank you', text='thank you for meeting!')
-    fup2 = Template(name='follow up', text='hello there')
-    db.session.add_all([ty, ty2, fup, fup2])
+    # ADD TEMPLATES (ids; identical ones share a row, so ty2 is ty and fup2 is fup)
+    ty, ty2, fup, fup2 = intern([('thank you', 'thank you for meeting!'),
+                                 ('thank you', 'thank you for meeting!'),
+                                 ('follow up', 'hello there'),
+                                 ('follow up', 'hello there')])
     db.session.commit()
     # ADD EVENTS
-    e1 = Event(contact_id=ian.id, date=datetime.datetime(2017, 12, 30), template_id=fup.id)
-    e2 = Event(contact_id=john.id, template_id=ty.id)
-    e3 = Event(contact_id=ian.id, template_id=ty2.id)
-    e4 = Event(contact_id=sally.id, date=datetime.datetime(2018, 1, 1), template_id=fup2.id)
+    e1 = Event(contact_id=ian.id, user_id=bob.id, date=datetime.datetime(2017, 12, 30), template_id=fup)
+    e2 = Event(contact_id=john.id, user_id=jane.id, template_id=ty)
+    e3 = Event(contact_id=ian.id, user_id=bob.id, template_id=ty2)
+    e4 = Event(contact_id=sally.id, user_id=bob.id, date=datetime.datetime(2018, 1, 1), template_id=fup2)
     db.session.add_all([e1, e2, e3, e4])
     db.session.commit()
     # ADD CONTACTEVENT ASSOCIATIONS
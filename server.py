@@ -1,12 +1,18 @@
 from jinja2 import StrictUndefined
 from flask import (Flask, render_template, redirect, request, flash, session,
-                   jsonify)
+                   jsonify, Response)
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from flask.ext.bcrypt import Bcrypt
-from werkzeug.security import generate_password_hash, check_password_hash
-from model import User, Event, ContactEvent, Contact, Template, db, connect_to_db
-import random, json
+import passwords
+# fork the hashing workers now, before the delivery pools or anything else
+# imported below starts a thread
+passwords.start()
+from model import (User, Event, ContactEvent, Contact, Template, ImportJob, db, connect_to_db,
+                   replica)
+import random, json, pytz, hashlib
+import metrics
 from quotes import *
 
 # SendGrid Emailing
@@ -18,7 +24,16 @@ from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
 
 # Threading schedule jobs
-from schedule_jobs import schedule1
+from schedule_jobs import schedule1, wake_scheduler, get_sms, day_range, REMINDER_OFFSET
+from phones import to_e164
+from fragment_cache import fragments, bump
+from removal import delete_contacts, delete_events
+from template_store import retext
+from event_batch import create_events, BatchError, parse_date, parse_recurrence
+from contact_import import enqueue_import, resume_imports, job_status
+from profile_view import (load_profile, contacts_page, events_page, history_page,
+                          ProfileView)
+from functools import wraps
 import threading
 
 app = Flask(__name__)
@@ -26,18 +41,45 @@ app = Flask(__name__)
 # Required to use Flask sessions and the debug toolbar
 app.secret_key = "ABC"
 app.jinja_env.undefined = StrictUndefined # raise error if you use undefined variable in Jinja2
+metrics.instrument_app(app) # request latencies and SQL query counts for /metrics
 
 
-# Source secrets and create client for Twilio
-account = os.environ.get('TWILIO_TEST_ACCOUNT')
-token = os.environ.get('TWILIO_TEST_TOKEN')
-client = Client(account, token)
-
+# Twilio sends go through schedule_jobs' shared, pooled SmsTransport (get_sms)
 twilio_num = os.environ.get('TWILIO_NUMBER')
 my_num = os.environ.get('MY_NUMBER')
 my_email = os.environ.get('MY_EMAIL')
 kit_email = os.environ.get('KIT_EMAIL')
 
+# After a user posts anything their reads stay on the primary this long, so
+# the page they're redirected to shows the change even if the replica lags
+REPLICA_LAG_SECONDS = int(os.environ.get('REPLICA_LAG_SECONDS') or 10)
+
+
+@app.after_request
+def remember_write(response):
+    if request.method == 'POST' and session.get('user_id'):
+        session['wrote_at'] = time.time()
+    return response
+
+
+def read_only(view):
+    """Serve the view from the read replica (when there is one) unless the
+    user wrote something in the last REPLICA_LAG_SECONDS."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if time.time() - session.get('wrote_at', 0) < REPLICA_LAG_SECONDS:
+            return view(*args, **kwargs)
+        with replica():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/metrics')
+def return_metrics():
+    """Counters and histograms in the Prometheus text format."""
+    return Response(metrics.registry.render(),
+                    mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/quote')
 def return_quote():
@@ -56,18 +98,13 @@ def return_msg():
 
 
 def add_fb_conctacts(contacts_list):
-    """If a user registers in via OAuth, add their FB friends as contacts."""
+    """If a user registers in via OAuth, queue their FB friends to be added as
+    contacts; returns the ImportJob."""
     user_id = session['user_id']
-    for thing in contacts_list:
-        try:
-            name = thing[0].encode('utf-8')
-            pic_url = thing[1]
-            c = Contact(name=name, pic_url=pic_url, user_id=user_id)
-            db.session.add(c)
-            db.session.commit()
-            print "{} add to DB for user_id={}".format(name, user_id)
-        except:
-            pass
+    job = enqueue_import(user_id, contacts_list)
+    print "queued {} FB contacts for user_id={} as import job {}".format(
+        job.total, user_id, job.id)
+    return job
 
 
 @app.route('/fb_register', methods=['POST'])
@@ -83,7 +120,6 @@ def fb_register():
     contacts_list = json.loads(request.form.get('contacts_list'))
 
     password = request.form.get('fb_uid')
-    hashed_value = generate_password_hash(password)
 
     db_user = User.query.filter(User.email == email).first()
 
@@ -95,6 +131,7 @@ def fb_register():
     else:
         # Add new_user to database; return new_user.id
         print "email doesn't exist--> New user being adding to DB and logging in"
+        hashed_value = passwords.hash_password(password)
         new_user = User(email=email, password=hashed_value, fname=fname, lname=lname, fb_uid=fb_uid, pic_url=pic_url)
         db.session.add(new_user)
         db.session.commit()
@@ -103,10 +140,21 @@ def fb_register():
         print "user added to session"
         if contacts_list:
             print "about to add FB contacts"
-            add_fb_conctacts(contacts_list)
+            job = add_fb_conctacts(contacts_list)
+            return jsonify({'user_id':new_user.id, 'result': 'Newly registered user!',
+                            'import_job': job.id})
         return jsonify({'user_id':new_user.id, 'result': 'Newly registered user!'})
 
 
+@app.route('/import_status/<int:job_id>')
+def import_status(job_id):
+    """Progress of a background contact import, for project.js to poll."""
+    job = ImportJob.query.get(job_id)
+    if job is None or job.user_id != session.get('user_id'):
+        return jsonify({'error': 'no such import'}), 404
+    return jsonify(job_status(job))
+
+
 @app.route('/')
 def index():
     """Homepage."""
@@ -119,12 +167,27 @@ def index():
 
 
 @app.route('/profile')
+@read_only
 def return_template():
     user_id = session.get('user_id')
     user = User.query.get(user_id)
     if user:
+        loaded = []
+        def render(template):
+            def render_fragment():
+                # only hit the database for sections that aren't cached
+                if not loaded:
+                    loaded.append(load_profile(user_id, user=user))
+                return render_template(template, profile=loaded[0])
+            return render_fragment
+        page = {'queued': fragments.get_or_render(user_id, 'queued',
+                                                  render('_queued_section.html')),
+                'contacts': fragments.get_or_render(user_id, 'contacts',
+                                                    render('_contact_grid.html')),
+                'contact_options': fragments.get_or_render(user_id, 'contact_options',
+                                                           render('_contact_options.html'))}
         try:
-            return render_template('test.html', user=user)
+            return render_template('test.html', user=user, fragments=page)
         except:
             pass
     else:
@@ -142,7 +205,6 @@ def register_process():
     # Grab information from registration form
     email = request.form.get('email')
     password = request.form.get('password')
-    hashed_value = generate_password_hash(password)
     fname = request.form.get('fname')
     lname = request.form.get('lname')
     phone = request.form.get('phone')
@@ -153,8 +215,12 @@ def register_process():
         # Alert the email is already in use; prompt them to login instead
         flash("Email already exists in database -- Please try logging in")
         return redirect('/')
+    elif to_e164(phone) and User.query.filter(User.phone_e164 == to_e164(phone)).first():
+        flash("That phone number is already registered -- Please try logging in")
+        return redirect('/')
     else:
         # Register new user; add to DB; log them in; save user_id to session
+        hashed_value = passwords.hash_password(password)
         new_user = User(email=email, 
                         password=hashed_value, 
                         fname=fname, 
@@ -177,8 +243,13 @@ def login_process():
     # If that user exists in DB:
     if db_user:
         # Verify password; redirect to their profile
-        password = db_user.password
-        if check_password_hash(password, login_password):
+        ok, rehash = passwords.verify(db_user.password, login_password)
+        if ok:
+            if rehash:
+                # stored with an older algorithm or cost; upgrade it now that
+                # we have the plain password
+                db_user.password = passwords.hash_password(login_password)
+                db.session.commit()
             session['user_id'] = db_user.id # add user_id to the session
             flash("You have successfully logged in!")
             return redirect('/profile')
@@ -191,64 +262,148 @@ def login_process():
         flash("Email does not exist in database: please register")
         return redirect('/')
 
-@app.route('/contact.json', methods=['POST'])
-def return_contact_info():
-    contact_id = request.form.get('contact_id')
-    contact = Contact.query.get(contact_id)
-    return jsonify({'id':contact.id, 'name': contact.name, 'email': contact.email, 
-                    'address': contact.address, 'phone': contact.phone})
+@app.route('/contacts.json')
+@read_only
+def return_contacts_info():
+    """Contacts by id (?ids=1,2,3) for the edit forms.
+
+    The ETag comes from each contact's version and Last-Modified from the
+    newest updated_at, so the browser revalidates with a 304 instead of
+    downloading again."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'not logged in'}), 401
+    try:
+        ids = sorted(set(int(i) for i in request.args.get('ids', '').split(',') if i))
+    except ValueError:
+        return jsonify({'error': 'ids must be comma-separated integers'}), 400
+    contacts = []
+    if ids:
+        contacts = (Contact.query.filter(Contact.user_id == user_id, Contact.id.in_(ids))
+                    .order_by(Contact.id).all())
+    response = jsonify({'contacts': [{'id': c.id, 'name': c.name, 'email': c.email,
+                                      'address': c.address, 'phone': c.phone,
+                                      'pic_url': c.pic_url}
+                                     for c in contacts]})
+    versions = ','.join('{}:{}'.format(c.id, c.version) for c in contacts)
+    response.set_etag(hashlib.sha1('{}|{}'.format(user_id, versions)).hexdigest(), weak=True)
+    if contacts:
+        response.last_modified = max(c.updated_at for c in contacts)
+    # per user, so only the browser may keep it, and it must revalidate
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Cookie'
+    return response.make_conditional(request)
+
+
+@app.route('/api/contacts')
+@read_only
+def api_contacts():
+    """Next page of the user's contacts (by name) with their events.
+
+    html holds the rendered cards so the profile can append them as is."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'not logged in'}), 401
+    contacts, events, next_cursor = contacts_page(user_id, request.args.get('after'))
+    page = ProfileView(None, contacts, events, [])
+    return jsonify({
+        'contacts': [{'id': c.id, 'name': c.name, 'email': c.email, 'phone': c.phone,
+                      'pic_url': c.pic_url,
+                      'events': [{'id': e.id, 'date': e.date.isoformat(),
+                                  'template_name': e.template.name,
+                                  'job_done': e.job_done}
+                                 for e in page.events_for(c)]}
+                     for c in contacts],
+        'html': ''.join(render_template('_contact_card.html', profile=page, contact=c)
+                        for c in contacts),
+        'next': next_cursor})
+
+
+@app.route('/api/events')
+@read_only
+def api_events():
+    """Next page of the user's queued events (by date)."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'not logged in'}), 401
+    pairs, next_cursor = events_page(user_id, request.args.get('after'))
+    return jsonify({
+        'events': [{'id': e.id, 'date': e.date.isoformat(), 'template_name': e.template.name,
+                    'contact_id': c.id, 'contact_name': c.name, 'pic_url': c.pic_url}
+                   for e, c in pairs],
+        'html': ''.join(render_template('_queued_event.html', event=e, contact=c)
+                        for e, c in pairs),
+        'next': next_cursor})
+
+
+@app.route('/api/history')
+@read_only
+def api_history():
+    """Next page of the user's archived events, newest first."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'not logged in'}), 401
+    pairs, next_cursor = history_page(user_id, request.args.get('after'))
+    return jsonify({
+        'events': [{'id': h.id, 'date': h.date.isoformat(), 'template_name': h.template_name,
+                    'text': h.template_text, 'contact_id': c.id, 'contact_name': c.name,
+                    'pic_url': c.pic_url}
+                   for h, c in pairs],
+        'html': ''.join(render_template('_history_event.html', event=h, contact=c)
+                        for h, c in pairs),
+        'next': next_cursor})
 
 
 @app.route('/add_event', methods=['POST'])
 def handle_event_form():
     """Validates and adds new event and template to DB."""
-    # Need to add the contact and template before creating an event
+    user = User.query.get(session.get("user_id"))
     name = request.form.get('contact_name')
-    email = request.form.get('contact_email')
-    phone = request.form.get('contact_phone')
-    address = request.form.get('contact_address')
-    user_id = session.get("user_id")
-    new_contact = Contact(name=name, 
-                          email=email, 
-                          phone=phone, 
-                          address=address, 
-                          user_id=user_id)
-    db.session.add(new_contact)
-    db.session.commit()
-    greet = "Hi"
-    sign_off = "Yours"
-    body = request.form.get('body')
-    user_fname = User.query.get(user_id).fname
-    contact_fname = name.encode('utf-8').split()[0]
-    template_text = "{} {}, \n{} \n{},\n{}".format(greet, contact_fname, body, sign_off,
-                                                   user_fname)
-
-    # add template
-    template_name = request.form.get('template_name')
-    new_template = Template(name=template_name, text=template_text)
-    db.session.add(new_template)
-    db.session.commit()
-
-    # add event
-    contact_id = new_contact.id
-    date = request.form.get('date')
-    new_event = Event(contact_id=contact_id, 
-                      user_id=user_id, 
-                      template_id=new_template.id, 
-                      date=date)
-    db.session.add(new_event)
-    db.session.commit()
-
-    # add ContactEvent association
-    ce = ContactEvent(contact_id=contact_id, event_id=new_event.id)
-    db.session.add(ce)
-    db.session.commit()
+    entry = {'name': name,
+             'email': request.form.get('contact_email'),
+             'phone': request.form.get('contact_phone'),
+             'address': request.form.get('contact_address'),
+             'template_name': request.form.get('template_name'),
+             'body': request.form.get('body'),
+             'date': request.form.get('date'),
+             'recurrence': request.form.get('recurrence'),
+             'recur_every': request.form.get('recur_every'),
+             'sign_off': "Yours"}
+    try:
+        create_events(user, [entry])
+    except BatchError as e:
+        flash("Couldn't add that event: {}".format(e.errors[0]['error']))
+        return redirect('/profile')
+    wake_scheduler()
+    bump(user.id)
 
     # redirect to user profile
     flash("You have successfully added a new event for {}!".format(name))
     return redirect('/profile')
 
 
+@app.route('/api/events/batch', methods=['POST'])
+def batch_events():
+    """Schedule many events at once, e.g. a birthday message to every contact.
+
+    Takes {"events": [{"contact_id" or "name"/"email"/"phone", "date",
+    "template_name", "body", optionally "recurrence" and "recur_every"},
+    ...]}; all are created or none are."""
+    user = User.query.get(session.get('user_id'))
+    if user is None:
+        return jsonify({'error': 'not logged in'}), 401
+    entries = (request.get_json(silent=True) or {}).get('events')
+    if not isinstance(entries, list) or not all(isinstance(e, dict) for e in entries):
+        return jsonify({'error': 'expected {"events": [...]}'}), 400
+    try:
+        event_ids = create_events(user, entries)
+    except BatchError as e:
+        return jsonify({'error': 'invalid entries', 'entries': e.errors}), 400
+    wake_scheduler()
+    bump(user.id)
+    return jsonify({'created': event_ids})
+
+
 @app.route('/handle_edits', methods=['POST'])
 def modify_db():
     """Allow user to change event and template that will go into DB."""
@@ -261,15 +416,33 @@ def modify_db():
     user = User.query.get(user_id)
     event = Event.query.get(event_id)
     contact = Contact.query.filter(Contact.id == event.contact_id).one()
+    text = request.form.get('template_text')
+    try:
+        date = parse_date(request.form.get('date'))
+        recurrence, every = parse_recurrence(request.form)
+        if not text or not text.strip():
+            raise ValueError("the message can't be empty")
+    except (TypeError, ValueError) as e:
+        flash("Couldn't update that message: {}".format(e))
+        return redirect("/profile")
 
     # update contact, event, template objects in the DB
     contact.name = request.form.get('contact_name')
-    event.template.text = request.form.get('template_text')
+    retext(event, text)
     contact.email = request.form.get('contact_email')
     contact.phone = request.form.get('contact_phone')
     contact.address = request.form.get('contact_address')
-    event.date = request.form.get('date')
+    # repeats are counted from recurs_from, so a moved date or a new rule
+    # starts the series again from the new date
+    if recurrence and (date != event.date or recurrence != event.recurrence or
+                       every != event.recur_every or event.recurs_from is None):
+        event.recurs_from = date
+    elif not recurrence:
+        event.recurs_from = None
+    event.date, event.recurrence, event.recur_every = date, recurrence, every
     db.session.commit()
+    wake_scheduler()
+    bump(user_id)
     flash("Message updated successfully. We will remind you the day before (on {}/{}/{})".format(event.date.month, event.date.day-1, event.date.year))
     return redirect("/profile")
 
@@ -280,15 +453,14 @@ def remove_event():
  
     user_id = session.get("user_id")
     if user_id:
-        # get event_id from hidden input;  
-        event_id = request.form.get('event_id')
-        template_id = Event.query.get(event_id).template_id
-        # delete ContactEvent association table link 
-        ContactEvent.query.filter(ContactEvent.event_id == event_id).delete()
-        # and then delete the Event
-        Event.query.filter(Event.id == event_id).delete()
-        Template.query.filter(Template.id == template_id).delete()
-        db.session.commit()
+        # get event_id from hidden input; contactsevents rows cascade
+        try:
+            event_id = int(request.form.get('event_id'))
+        except (TypeError, ValueError):
+            flash("Couldn't delete that event: event_id must be an integer")
+            return redirect("/profile")
+        delete_events(user_id, [event_id])
+        bump(user_id)
         flash("You have successfully deleted this event")
         return redirect("/profile")
     else:
@@ -299,32 +471,37 @@ def remove_event():
 def remove_contact():
     """Delete contact (and their events, and templates) from DB."""
     user_id = session.get("user_id")
-    contact_id = request.form.get('contact_id')
     if user_id:
-        # delete the ContactEvent association 
-        ContactEvent.query.filter(ContactEvent.contact_id == contact_id).delete()
-        # delete their Events and their templates    
-        events = Event.query.filter(Event.contact_id == contact_id).all()
-        # get the template ids for all of the events for that one contact
-        template_ids = []
-        for event in events:
-            template_ids.append(event.template_id)
-        # delete the events
-        Event.query.filter(Event.contact_id == contact_id).delete()
-        db.session.commit()
-        # delete the templates
-        for template_id in template_ids:
-            Template.query.filter(Template.id == template_id).delete()
-            db.session.commit()
-        # delete the contact
-        Contact.query.filter(Contact.id == contact_id).delete()
-        db.session.commit()
+        try:
+            contact_id = int(request.form.get('contact_id'))
+        except (TypeError, ValueError):
+            flash("Couldn't delete that contact: contact_id must be an integer")
+            return redirect("/profile")
+        delete_contacts(user_id, [contact_id])
+        bump(user_id)
         flash("You have successfully deleted this contact")
         return redirect("/profile")
     else:
         flash("You must log in or register to remove contacts")
         return redirect("/")
 
+@app.route('/remove_contacts', methods=['POST'])
+def remove_contacts():
+    """Delete many contacts at once, e.g. unwanted Facebook imports.
+
+    Takes {"contact_ids": [...]}; returns how many were deleted."""
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({'error': 'not logged in'}), 401
+    contact_ids = (request.get_json(silent=True) or {}).get('contact_ids')
+    try:
+        contact_ids = [int(i) for i in contact_ids]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'expected {"contact_ids": [...]}'}), 400
+    deleted = delete_contacts(user_id, contact_ids)
+    bump(user_id)
+    return jsonify({'deleted': deleted})
+
 
 ####### specifically given a contact #################
 
@@ -344,56 +521,27 @@ def add_event_for_contact(contact_id):
 @app.route('/handle_new_event_for_contact', methods=['POST'])
 def handle_new_event_for_contact():
     """Handle new event for contact form; updates DB"""
-    # Get user object
-    user_id = session.get('user_id')
-    user = User.query.get(user_id)
-    # Get contact object (hidden input from event_for_contact.html)
-    contact_id = request.form.get('contact_id')
-    contact = Contact.query.get(contact_id)
-    # if receiving from create_new_event form AND they updated the contact's information,
-    # update DB
-    if contact:
-        if request.form.get('contact_name'):
-            name = request.form.get('contact_name')
-            contact.name = name
-            db.session.commit()
-        if request.form.get('contact_email'):
-            email = request.form.get('contact_email')
-            contact.email = email
-            db.session.commit()
-        if request.form.get('contact_phone'):
-            phone = request.form.get('contact_phone')
-            contact.phone = phone
-            db.session.commit()
-        if request.form.get('contact_address'):
-            address = request.form.get('contact_address')
-            contact.address = address
-            db.session.commit()
-    # get inputs from form for template text
-    greet = "Hi"
-    sign_off = "Best"
-    body = request.form.get('body')
-    contact_fname = contact.name.encode('utf-8').split()[0]
-    user_fname = user.fname
-    template_text = "{} {}, \n{} \n{},\n{}".format(greet, contact_fname, body, sign_off,
-                                                   user_fname)
-    # add template
-    template_name = request.form.get('template_name')
-    new_template = Template(name=template_name, text=template_text)
-    db.session.add(new_template)
-    db.session.commit()
-    # add event
-    date = request.form.get('date')
-    new_event = Event(contact_id=contact_id, 
-                      user_id=user_id, 
-                      template_id=new_template.id, 
-                      date=date)
-    db.session.add(new_event)
-    db.session.commit()
-    # add ContactEvent association
-    ce = ContactEvent(contact_id=contact_id, event_id=new_event.id)
-    db.session.add(ce)
-    db.session.commit()
+    user = User.query.get(session.get('user_id'))
+    # contact_id is a hidden input; the contact fields are only sent (and
+    # only updated) when coming from the create_new_event form
+    entry = {'contact_id': request.form.get('contact_id'),
+             'name': request.form.get('contact_name'),
+             'email': request.form.get('contact_email'),
+             'phone': request.form.get('contact_phone'),
+             'address': request.form.get('contact_address'),
+             'template_name': request.form.get('template_name'),
+             'body': request.form.get('body'),
+             'date': request.form.get('date'),
+             'recurrence': request.form.get('recurrence'),
+             'recur_every': request.form.get('recur_every')}
+    try:
+        create_events(user, [entry])
+    except BatchError as e:
+        flash("Couldn't add that event: {}".format(e.errors[0]['error']))
+        return redirect("/profile")
+    wake_scheduler()
+    bump(user.id)
+    contact = Contact.query.get(entry['contact_id'])
     flash("You have successfully added a new event for {}!".format(contact.name.encode('utf-8')))
     return redirect("/profile")
 
@@ -404,13 +552,23 @@ def handle_profile_edits():
     lname = request.form.get('lname')
     email = request.form.get('email')
     phone = request.form.get('phone')
+    timezone = request.form.get('timezone')
     if user_id:
         user = User.query.get(user_id)
         user.fname = fname
         user.lname = lname
         user.email = user.email
         user.phone = phone
-        db.session.commit()
+        if timezone in pytz.all_timezones_set:
+            user.timezone = timezone
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # ix_users_phone_e164: someone else has this number
+            db.session.rollback()
+            flash("That phone number is already in use.")
+            return redirect("/profile")
+        bump(user_id)
         flash("Your information has been updated successfully.")
         return redirect("/profile")
     else:
@@ -431,6 +589,7 @@ def edit_contact_db(contact_id):
     contact = Contact.query.get(contact_id)
     contact.name, contact.email, contact.phone, contact.address = name, email, phone, address
     db.session.commit()
+    bump(contact.user_id)
     flash("{}'s information has been updated!".format(contact.name))
     user_id = session.get('user_id')
     return redirect("/profile")
@@ -446,7 +605,7 @@ def text_reminder(event):
     my_msg = "\n\n\nHello {}, your event's coming up tomorrow for {}.\n\n--------\n\nYour message \
 currently is:\n'{}'\n\n--------\n\nIf you'd like to update this message, please \
 reply with your new message (in one SMS response. Please add 'event_id={}' in your response)".format(user_fname, c_name, event.template.text, event.id)
-    message = client.messages.create(to=user_phone, from_=twilio_num, body=my_msg)
+    message = get_sms().send(user_phone, my_msg)
     print "MESSAGE SENT to {}".format(user_phone)
 
 
@@ -455,47 +614,48 @@ reply with your new message (in one SMS response. Please add 'event_id={}' in yo
 
 @app.route("/sms", methods=['GET', 'POST'])
 def handle_reminder_response():
-    print "msg received from user"
     """Handle user response to reminder"""
-    to_number = request.values.get('To') # Keep in Touch's phone
     from_number = request.values.get('From', None) # user's phone
-    user_response = request.values.get('Body')
-    # Fetch user from DB to update event template text
-    print from_number
-    user = User.query.filter(User.phone == from_number).one()
-    user_fname = user.fname
-    event_id = None
-    # Get tomorrow's date to fetch the events, formatted to match DB date fields
-    t = datetime.datetime.now()
-    today = datetime.datetime(t.year, t.month, t.day, 0, 0)
-    # tmrw = datetime.datetime(t.year, t.month, t.day+1, 0, 0)
+    user_response = request.values.get('Body') or ''
+    resp = MessagingResponse()
+    # Fetch user from DB (unique index on the normalized number)
+    phone = to_e164(from_number)
+    user = phone and User.query.filter(User.phone_e164 == phone).first()
+    if user is None:
+        print "msg from unknown number {}".format(from_number)
+        return str(resp)
 
     if "event_id" in user_response.lower():
-        eindex = user_response.index("event_id")
+        eindex = user_response.lower().index("event_id")
         # Get event_id from incoming text
-        event_id = int(user_response[(eindex + len("event_id=")):])
-        event = Event.query.get(event_id)
-        new_text = user_response[:eindex].rstrip()
-        # Update database with new event template text for their contact
-        event.template.text = new_text
-        db.session.commit()
-        # Send confirmation text of the change
-        message = "Thanks, {}! Your new message will be updated in the database as: '{}'".format(user_fname, event.template.text)
-        resp = MessagingResponse()
-        resp.message(body=message)
-        print "msg sent to user"
-        return str(resp)
-    else:
-        print "msg fail"
-        # Reply to user, prompting to end new message with "event_id=XX"
-        for contact in user.contacts:
-            for event in contact.events:
-                if event.date == tmrw:
-                    # Will unfortunately have to send this to every event tomorrow
-                    my_msg = "You didn't add 'event_id={id}' in your response. Please text us the same message with the 'event_id={id}' at the end".format(id=event.id)
-                    message = client.messages.create(to=from_number, 
-                                                     from_=to_number, 
-                                                     body=my_msg)
+        try:
+            event_id = int(user_response[(eindex + len("event_id=")):].strip())
+        except ValueError:
+            event_id = None
+        event = event_id and Event.query.filter(Event.id == event_id,
+                                                Event.user_id == user.id).first()
+        if event:
+            new_text = user_response[:eindex].rstrip()
+            # Update database with new event template text for their contact
+            # (a copy, if other events share the old text)
+            retext(event, new_text)
+            db.session.commit()
+            bump(user.id)
+            # Send confirmation text of the change
+            resp.message(body="Thanks, {}! Your new message will be updated in the database as: '{}'".format(user.fname, new_text))
+            return str(resp)
+
+    # Reply to user, prompting to end new message with "event_id=XX" for each
+    # of the events they were reminded about (those due tomorrow, their time)
+    local_now = datetime.datetime.now(pytz.timezone(user.timezone)).replace(tzinfo=None)
+    start, end = day_range(local_now + REMINDER_OFFSET)
+    event_ids = db.session.query(Event.id).filter(Event.user_id == user.id,
+                                                  Event.date >= start, Event.date < end,
+                                                  Event.job_done == False).order_by(Event.id)
+    for (event_id,) in event_ids:
+        # replies ride along in the TwiML response, so no API calls here
+        resp.message(body="You didn't add 'event_id={id}' in your response. Please text us the same message with the 'event_id={id}' at the end".format(id=event_id))
+    return str(resp)
 
 
 
@@ -504,6 +664,7 @@ if __name__ == "__main__":
     # app.debug = True
     # app.jinja_env.auto_reload = app.debug  # make sure templates, etc. are not cached in debug mode
     connect_to_db(app)
+    resume_imports()
     # DebugToolbarExtension(app) # Use the DebugToolbar
     
     def run_app():
@@ -0,0 +1,74 @@
+"""Twilio SMS sending over a pooled, keep-alive HTTP connection.
+
+One SmsTransport is shared by the scheduler and the /sms webhook. It keeps
+a requests.Session with a bounded connection pool under the Twilio client
+and records how long each API request took.
+"""
+from collections import deque
+from delivery import WorkerPool, percentile
+from twilio.http import HttpClient
+from twilio.http.response import Response
+from twilio.rest import Client
+import metrics, requests, threading, time
+
+TWILIO_API = 'https://api.twilio.com'
+
+
+class PooledHttpClient(HttpClient):
+    """Twilio HttpClient on one requests.Session with pool_size connections.
+
+    base_url, if set, replaces https://api.twilio.com (for a local fake).
+    """
+
+    def __init__(self, pool_size=10, timeout=10, base_url=None):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size,
+                                                pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = timeout
+        self.base_url = base_url
+        self.latencies = deque(maxlen=10000)    # seconds, most recent requests
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                auth=None, timeout=None, allow_redirects=False):
+        if self.base_url and url.startswith(TWILIO_API):
+            url = self.base_url + url[len(TWILIO_API):]
+        start = time.time()
+        response = self.session.request(method, url, params=params, data=data,
+                                        headers=headers, auth=auth,
+                                        timeout=timeout or self.timeout,
+                                        allow_redirects=allow_redirects)
+        elapsed = time.time() - start
+        metrics.observe('provider_request_seconds', elapsed, provider='twilio')
+        with self._lock:
+            self.latencies.append(elapsed)
+        return Response(int(response.status_code), response.text)
+
+
+class SmsTransport(object):
+    """Sends SMS synchronously (send) or on a worker pool (send_async)."""
+
+    def __init__(self, account, token, from_, pool_size=10, base_url=None):
+        self.from_ = from_
+        self.http = PooledHttpClient(pool_size=pool_size, base_url=base_url)
+        self.client = Client(account, token, http_client=self.http)
+        self.pool = WorkerPool(pool_size, name='sms')
+
+    def send(self, to, body, from_=None):
+        """Send one SMS; returns Twilio's message resource."""
+        return self.client.messages.create(to=to, from_=from_ or self.from_, body=body)
+
+    def send_async(self, to, body, from_=None):
+        """Queue one SMS; returns a delivery.Pending for the message."""
+        return self.pool.submit(self.send, to, body, from_)
+
+    def latency(self):
+        """Count, p50 and p99 (in ms) of recent Twilio API requests."""
+        with self.http._lock:
+            samples = list(self.http.latencies)
+        return {'count': len(samples),
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000}
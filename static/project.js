@@ -121,6 +121,8 @@ function getInfoRegisterLogin() {
                         'pic_url': pic_url,
                         'contacts_list': JSON.stringify(contactsList) };
         $.post('/fb_register', loginInputs, function(data){
+            // friends are imported in the background; the profile polls for it
+            if (data['import_job']) sessionStorage.setItem('importJob', data['import_job']);
             if (data['user_id']) window.location.href = "/profile";
     });
 });
@@ -187,28 +189,28 @@ $(document).ready(function() {
 
 
 // When user clicks on a contact name:
-// display all of contact's events, add_event for this contact, delete contact
-function showEvents(results) {
-    let contact_id = results['contact_id'];
-    let element = $("#contact-options-"+contact_id);
+// toggle the contact's details under it (from the cacheable GET /contacts.json)
+function showDetails(contact) {
+    let element = $("#contact-options-" + contact['id']);
     if (element.html() === '') {
-        for (let e_id in results['events']) {
-            $(element).append("<li>" + results['events'][e_id]["date"] + ": " + results['events'][e_id]["template_name"] + "</li>");
+        for (let field of ['email', 'phone', 'address']) {
+            if (contact[field]) { element.append($('<li>').text(contact[field])); }
         }
-    } 
+    }
     else {
         element.html(''); }
 }
 
-// On user profile, click on a contact and show events /////////////////////////
+// On user profile, click on a contact and show details ////////////////////////
 function showOptions(evt) {
-    let contact_id = $(this).attr('id');
-    let url = "/contact.json";
-    let formInputs = { "contact_id" : contact_id};
-    $.post(url, formInputs, showEvents);
-}   
+    let contactID = $(this).attr('id');
+    $.get('/contacts.json', {"ids": contactID}, function(results) {
+        if (results['contacts'].length) showDetails(results['contacts'][0]);
+    });
+}
 
-$('.contact-name').on("click", showOptions);
+// delegated, so cards appended by scroll paging get it too
+$(document).on("click", '.contact-name', showOptions);
 
 
 // When creating an event, ensure dates are today or in the future /////////////
@@ -295,10 +297,10 @@ function fillInForm(results) {
 
 function getContactInfo(evt) {
     let contactID = $('.choose-existing').val();
-    console.log(contactID);
-    let url = "/contact.json";
-    let formInputs = {"contact_id": contactID};
-    $.post(url, formInputs, fillInForm);
+    // a GET, so the browser revalidates its copy against the ETag
+    $.get('/contacts.json', {"ids": contactID}, function(results) {
+        if (results['contacts'].length) fillInForm(results['contacts'][0]);
+    });
 }
 
 $(document).ready(function () {
@@ -315,3 +317,85 @@ $(function() {
 })
 
 
+
+// load more contacts and queued messages as the user scrolls ///////////////
+// /api/contacts and /api/events hand back the next page and its cursor
+var loadingPage = false;
+
+function loadContacts() {
+    let grid = $('.grid');
+    let after = grid.data('next');
+    if (!after || loadingPage) { return; }
+    loadingPage = true;
+    $.get('/api/contacts', {'after': after}, function(results) {
+        let items = $($.parseHTML(results['html']));
+        grid.append(items).masonry('appended', items.filter('.grid-item'));
+        for (let contact of results['contacts']) {
+            $('.choose-existing').append($('<option>').val(contact['id']).text(contact['name']));
+        }
+        grid.data('next', results['next'] || '');
+    }).always(function() {
+        // cleared on failure too, so the next scroll retries the page
+        loadingPage = false;
+    });
+}
+
+function loadQueued(evt) {
+    let row = $('.queue-row');
+    let after = row.data('next');
+    if (!after) { return; }
+    $.get('/api/events', {'after': after}, function(results) {
+        row.append(results['html']);
+        row.data('next', results['next'] || '');
+        if (!results['next']) { $('.queue-more').hide(); }
+    });
+}
+
+// sent messages live in event_history; fetched only when asked for
+function loadHistory(evt) {
+    let row = $('.history-row');
+    let after = row.data('next');
+    if (row.data('loaded') && !after) { return; }
+    $.get('/api/history', after ? {'after': after} : {}, function(results) {
+        row.data('loaded', true).show().append(results['html']);
+        row.data('next', results['next'] || '');
+        if (!results['next']) { $('.history-more').hide(); }
+        else { $('.history-more').text('More sent messages'); }
+    });
+}
+
+$(document).ready(function() {
+    $('.queue-more').on('click', loadQueued);
+    $('.history-more').on('click', loadHistory);
+    $(window).on('scroll', function() {
+        if ($(window).scrollTop() + $(window).height() > $(document).height() - 600) {
+            loadContacts();
+        }
+    });
+});
+
+
+// poll a background Facebook contact import until it finishes ///////////////
+function pollImport() {
+    let jobID = sessionStorage.getItem('importJob');
+    if (!jobID) { return; }
+    $.get('/import_status/' + jobID, function(results) {
+        let status = results['status'];
+        if (status === 'pending' || status === 'running') {
+            $('#import-status').html('Importing Facebook friends: ' +
+                results['processed'] + ' of ' + results['total']);
+            setTimeout(pollImport, 2000);
+            return;
+        }
+        sessionStorage.removeItem('importJob');
+        if (status === 'done' && results['added']) {
+            window.location.reload();
+        } else if (status === 'failed') {
+            $('#import-status').html("We couldn't import your Facebook friends.");
+        } else {
+            $('#import-status').html('');
+        }
+    }).fail(function() { sessionStorage.removeItem('importJob'); });
+}
+
+$(document).ready(pollImport);
@@ -0,0 +1,96 @@
+"""Templates stored once per distinct name and text.
+
+Every "thank you" with the same wording points at one templates row, found
+by its digest (model.template_digest) through the unique ix_templates_digest.
+Shared rows are never edited in place: retext() points the event at the row
+for its new text (copy-on-write) and drops the old one if nothing else uses
+it. Deletes do the same for the templates of the events they remove.
+
+A row being reused is locked FOR KEY SHARE until the transaction commits,
+and orphans are collected with SKIP LOCKED, so collection never takes a row
+out from under an event that is being created; a row it skips is picked up
+by sweep() (run from archive.py) later.
+"""
+from sqlalchemy import text
+from model import Template, db, template_digest
+
+FIND_SQL = text("SELECT id, digest FROM templates WHERE digest = ANY(:digests) "
+                "FOR KEY SHARE")
+INSERT_SQL = text("INSERT INTO templates (name, text, digest) "
+                  "SELECT * FROM unnest(CAST(:names AS varchar[]), CAST(:texts AS text[]), "
+                  "CAST(:digests AS varchar[])) "
+                  "ON CONFLICT (digest) DO NOTHING RETURNING id, digest")
+
+# orphans among the given template ids, for use in the deletes' CTEs: the
+# events being deleted by the same statement (in `gone`) don't count
+ORPHANS_SQL = """
+    SELECT t.id FROM templates t
+     WHERE t.id IN (SELECT template_id FROM {gone})
+       AND NOT EXISTS (SELECT 1 FROM events e
+                        WHERE e.template_id = t.id
+                          AND e.id NOT IN (SELECT id FROM {gone}))
+       FOR UPDATE SKIP LOCKED"""
+
+COLLECT_SQL = text("""
+DELETE FROM templates WHERE id IN (
+    SELECT t.id FROM templates t
+     WHERE t.id = ANY(:ids)
+       AND NOT EXISTS (SELECT 1 FROM events e WHERE e.template_id = t.id)
+       FOR UPDATE SKIP LOCKED)""")
+
+SWEEP_SQL = text("""
+DELETE FROM templates WHERE id IN (
+    SELECT t.id FROM templates t
+     WHERE NOT EXISTS (SELECT 1 FROM events e WHERE e.template_id = t.id)
+     LIMIT :limit
+       FOR UPDATE SKIP LOCKED)""")
+
+
+def intern(pairs):
+    """Template ids for a list of (name, text), in order, creating the rows
+    that don't exist yet. Doesn't commit."""
+    digests = [template_digest(name, body) for name, body in pairs]
+    wanted = dict(zip(digests, pairs))
+    ids = {}
+    while len(ids) < len(wanted):
+        missing = [d for d in wanted if d not in ids]
+        ids.update((digest, id) for id, digest in
+                   db.session.execute(FIND_SQL, {'digests': missing}))
+        missing = [d for d in missing if d not in ids]
+        if missing:
+            # rows another transaction inserts meanwhile are found next time round
+            ids.update((digest, id) for id, digest in db.session.execute(INSERT_SQL, {
+                'names': [wanted[d][0] for d in missing],
+                'texts': [wanted[d][1] for d in missing],
+                'digests': missing}))
+    return [ids[digest] for digest in digests]
+
+
+def collect(template_ids):
+    """Deletes whichever of template_ids no event uses any more."""
+    ids = [int(i) for i in template_ids if i is not None]
+    if ids:
+        db.session.execute(COLLECT_SQL, {'ids': ids})
+
+
+def retext(event, body, name=None):
+    """Copy-on-write edit of event's message. Doesn't commit."""
+    old = event.template
+    name = name or old.name
+    if template_digest(name, body) == old.digest:
+        return
+    event.template = Template.query.get(intern([(name, body)])[0])
+    db.session.flush()
+    collect([old.id])
+
+
+def sweep(limit=1000):
+    """Deletes orphaned templates left behind by skipped collections, limit
+    at a time; returns how many went."""
+    deleted = 0
+    while True:
+        count = db.session.execute(SWEEP_SQL, {'limit': limit}).rowcount
+        db.session.commit()
+        deleted += count
+        if count < limit:
+            return deleted
@@ -0,0 +1,63 @@
+"""Compare the old exact-match day scan with the indexed range scan.
+
+Run from the repo root against a throwaway database:
+    createdb project_bench
+    PYTHONPATH=. python testing/bench_due_events.py 3000000
+"""
+from flask import Flask
+from model import Event, Template, db, connect_to_db
+from schedule_jobs import return_due_events
+import datetime, sys, time
+
+BENCH_DB = "postgresql:///project_bench"
+
+
+def seed(n):
+    """Fill events with n rows spread over ten years, past ones done."""
+    db.drop_all()
+    db.create_all()
+    db.engine.execute("INSERT INTO users (email, password) VALUES ('b@b.com', 'x')")
+    db.engine.execute("INSERT INTO contacts (name, user_id) VALUES ('Bench', 1)")
+    db.engine.execute(Template.__table__.insert(), name='bench', text='hi')
+    db.engine.execute("""
+        INSERT INTO events (contact_id, template_id, user_id, date, job_done, reminder_sent)
+        SELECT 1, 1, 1, d, d < now(), d < now() + interval '1 day'
+          FROM (SELECT date_trunc('day', now()) - interval '5 years'
+                       + (g % 3650) * interval '1 day' AS d
+                  FROM generate_series(1, %s) g) s""", n)
+    db.engine.execute("ANALYZE events")
+
+
+def old_scan(day):
+    """What return_todays_events used to do: exact match, filter in Python."""
+    today = datetime.datetime(day.year, day.month, day.day, 0, 0)
+    events = Event.query.filter(Event.date == today).all()
+    return [e for e in events if e.job_done == False]
+
+
+def timed(fn, runs=5):
+    """Best wall time of runs calls to fn, in milliseconds."""
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        fn()
+        db.session.expunge_all()
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 3000000
+    app = Flask(__name__)
+    connect_to_db(app, BENCH_DB)
+    print "seeding {} events...".format(n)
+    seed(n)
+    day = datetime.datetime.now()
+
+    db.engine.execute("DROP INDEX ix_events_due")
+    print "old scan, no index:  {:.1f} ms".format(timed(lambda: old_scan(day)))
+    db.engine.execute("CREATE INDEX ix_events_due ON events (date, job_done, reminder_sent)")
+    db.engine.execute("ANALYZE events")
+    print "new scan, indexed:   {:.1f} ms".format(
+        timed(lambda: return_due_events(day, Event.job_done)))
@@ -0,0 +1,31 @@
+"""Throughput of SmsTransport against the local fake Twilio endpoint.
+
+Run from the repo root:
+    PYTHONPATH=.:testing python testing/bench_sms.py 5000 16
+"""
+from fakes import FakeTwilio, serve
+from sms_transport import SmsTransport
+import sys, time
+
+
+class SlowTwilio(FakeTwilio):
+    latency = 0.05      # roughly a real Twilio round trip
+
+
+if __name__ == "__main__":
+    sends = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    pool_size = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    server = serve(SlowTwilio)
+    sms = SmsTransport('AC' + '0' * 32, 'token', '+15550000000',
+                       pool_size=pool_size, base_url=server.url)
+    start = time.time()
+    pending = [sms.send_async('+1555{:07d}'.format(i), 'hello {}'.format(i))
+               for i in range(sends)]
+    for p in pending:
+        p.result()
+    elapsed = time.time() - start
+    stats = sms.latency()
+    print "{} sends, pool of {}: {:.0f} sends/min".format(sends, pool_size,
+                                                          sends / elapsed * 60)
+    print "latency p50 {:.1f} ms, p99 {:.1f} ms".format(stats['p50_ms'], stats['p99_ms'])
+    server.stop()
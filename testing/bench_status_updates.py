@@ -0,0 +1,38 @@
+"""Cost of flipping event flags: one commit per event vs mark_events().
+
+Run from the repo root against a throwaway database:
+    createdb project_bench
+    PYTHONPATH=.:testing python testing/bench_status_updates.py
+"""
+from flask import Flask
+from model import Event, db, connect_to_db
+from schedule_jobs import mark_events
+from bench_due_events import BENCH_DB, seed
+import time
+
+
+def per_event_commits(event_ids):
+    """What send_all_emails used to do."""
+    for event_id in event_ids:
+        event = Event.query.get(event_id)
+        event.job_done = True
+        db.session.commit()
+
+
+def reset(event_ids):
+    db.engine.execute("UPDATE events SET job_done = false WHERE id <= %s", max(event_ids))
+    db.session.expunge_all()
+
+
+if __name__ == "__main__":
+    app = Flask(__name__)
+    connect_to_db(app, BENCH_DB)
+    seed(100000)
+    for n in (10000, 100000):
+        event_ids = range(1, n + 1)
+        for name, fn in (("per-event commits", per_event_commits),
+                         ("mark_events", lambda ids: mark_events(ids, 'job_done'))):
+            reset(event_ids)
+            start = time.time()
+            fn(event_ids)
+            print "{:>7} events, {:<18} {:8.2f} s".format(n, name, time.time() - start)
@@ -0,0 +1,91 @@
+"""Run the test suite and EXPLAIN every query the app issues along the way,
+flagging any that would need a sequential scan.
+
+Run from the repo root against the test database:
+    createdb project
+    PYTHONPATH=.:testing python testing/check_seqscans.py
+
+Plans are taken with enable_seqscan off, so Postgres only falls back to a
+Seq Scan when no index can serve the query at all (on the tiny test tables
+it would otherwise pick one for everything). Queries issued directly from
+test code, like assertion lookups, are skipped. Exits non-zero if any app
+query needs a sequential scan, so a new query without an index fails here
+before it reaches a big table.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import json, os, sys, traceback, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTING = os.path.join(ROOT, 'testing')
+# tables that stay small by design, where a seq scan is the right plan
+SMALL_TABLES = set(['schema_version'])
+EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE', 'WITH', 'INSERT')
+
+flagged = {}    # statement -> (where it came from, tables scanned)
+
+
+def caller():
+    """'file:line function' of the app code that issued the query, or None
+    when it came from test code."""
+    for filename, lineno, function, _ in reversed(traceback.extract_stack()):
+        path = os.path.abspath(filename)
+        if not path.startswith(ROOT + os.sep):
+            continue
+        if path.startswith(TESTING + os.sep):
+            return None
+        return "{}:{} {}".format(os.path.relpath(path, ROOT), lineno, function)
+    return None
+
+
+def seq_scans(plan):
+    """Tables read by Seq Scan nodes anywhere in an EXPLAIN plan."""
+    tables = []
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        tables.extend(seq_scans(child))
+    return tables
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _explain(conn, cursor, statement, parameters, context, executemany):
+    if executemany or not statement.lstrip().upper().startswith(EXPLAINABLE):
+        return
+    where = caller()
+    if where is None:
+        return
+    # SAVEPOINT needs a transaction block, which autocommit connections (the
+    # migrations' CREATE INDEX CONCURRENTLY) don't have
+    if getattr(conn.connection, 'autocommit', False):
+        return
+    saved = False
+    try:
+        # a savepoint keeps a failed EXPLAIN from aborting the real transaction
+        cursor.execute("SAVEPOINT seqscan_check")
+        saved = True
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        tables = [t for t in seq_scans(plan[0]['Plan']) if t not in SMALL_TABLES]
+        if tables:
+            flagged[statement] = (where, sorted(set(tables)))
+    except Exception as e:
+        print "could not EXPLAIN from {}: {}".format(where, e)
+    finally:
+        if saved:
+            cursor.execute("ROLLBACK TO SAVEPOINT seqscan_check")
+            cursor.execute("RELEASE SAVEPOINT seqscan_check")
+
+
+if __name__ == "__main__":
+    import tests
+    suite = unittest.defaultTestLoader.loadTestsFromModule(tests)
+    unittest.TextTestRunner(verbosity=0).run(suite)
+    for statement, (where, tables) in sorted(flagged.items(), key=lambda item: item[1]):
+        print "\nSeq Scan on {} from {}:\n  {}".format(', '.join(tables), where,
+                                                      ' '.join(statement.split()))
+    print "\n{} app queries need a sequential scan".format(len(flagged))
+    sys.exit(1 if flagged else 0)
@@ -0,0 +1,210 @@
+"""Local stand-ins for the providers the scheduler talks to.
+
+Over HTTP, to exercise the real transports:
+    server = serve(FakeTwilio)
+    SmsTransport(..., base_url=server.url)
+
+In process, swapped in for schedule_jobs' sms and mailer:
+    install(schedule_jobs, latency=0.05, error_rate=0.01)
+"""
+from SocketServer import ThreadingMixIn
+from collections import namedtuple
+from delivery import Report
+import BaseHTTPServer, json, random, threading, time, urlparse, uuid
+
+
+class FakeServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server on a free local port; .url is its base URL."""
+
+    daemon_threads = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def serve(handler):
+    """Starts a FakeServer for handler on a background thread."""
+    server = FakeServer(('127.0.0.1', 0), handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+class FakeProvider(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive handler that records requests. Set latency (seconds) on
+    a subclass to slow every response down, and error_rate (0-1) to answer
+    that share of requests with a 500."""
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0
+    error_rate = 0
+
+    def failing(self):
+        """True if this request should get an injected error."""
+        return self.error_rate and random.random() < self.error_rate
+
+    def reply(self, status, payload=None):
+        body = json.dumps(payload) if payload is not None else ''
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeTwilio(FakeProvider):
+    """Answers POST /2010-04-01/Accounts/<sid>/Messages.json like Twilio."""
+
+    received = []
+
+    def do_POST(self):
+        form = dict((k, v[0]) for k, v in urlparse.parse_qs(self.read_body()).items())
+        self.received.append(form)
+        account_sid = self.path.split('/')[3]
+        if self.failing():
+            return self.reply(500, {'code': 20500, 'message': 'Injected error',
+                                    'more_info': 'https://www.twilio.com/docs/errors/20500',
+                                    'status': 500})
+        now = time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime())
+        sid = 'SM' + uuid.uuid4().hex
+        self.reply(201, {'sid': sid,
+                         'account_sid': account_sid,
+                         'messaging_service_sid': None,
+                         'to': form.get('To'),
+                         'from': form.get('From'),
+                         'body': form.get('Body'),
+                         'status': 'queued',
+                         'num_segments': '1',
+                         'num_media': '0',
+                         'direction': 'outbound-api',
+                         'api_version': '2010-04-01',
+                         'price': None,
+                         'price_unit': 'USD',
+                         'error_code': None,
+                         'error_message': None,
+                         'date_created': now,
+                         'date_updated': now,
+                         'date_sent': None,
+                         'subresource_uris': {},
+                         'uri': self.path.replace('.json', '/{}.json'.format(sid))})
+
+
+class FakeSendGrid(FakeProvider):
+    """Answers POST /v3/mail/send like SendGrid: 202 and an empty body."""
+
+    received = []
+
+    def do_POST(self):
+        self.received.append(json.loads(self.read_body()))
+        if self.failing():
+            return self.reply(500, {'errors': [{'message': 'Injected error'}]})
+        self.reply(202)
+
+
+##### In-process fakes ######
+
+FakeMessage = namedtuple('FakeMessage', ['sid', 'to', 'from_', 'body', 'status'])
+
+
+class InjectedError(Exception):
+    pass
+
+
+class _Fake(object):
+    def __init__(self, latency=0, error_rate=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.latencies = []     # seconds per provider request
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        """Sleep like a provider round trip; maybe raise an injected error."""
+        start = time.time()
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(time.time() - start)
+        if self.error_rate and random.random() < self.error_rate:
+            raise InjectedError("injected provider error")
+
+
+class FakeSms(_Fake):
+    """Drop-in for sms_transport.SmsTransport."""
+
+    def __init__(self, latency=0, error_rate=0, from_='+15550000000'):
+        _Fake.__init__(self, latency, error_rate)
+        self.from_ = from_
+        self.sent = []
+
+    def send(self, to, body, from_=None):
+        self._request()
+        message = FakeMessage('SM' + uuid.uuid4().hex, to, from_ or self.from_, body, 'queued')
+        with self._lock:
+            self.sent.append(message)
+        return message
+
+
+class FakeMailer(_Fake):
+    """Drop-in for email_backend.SendGridBatcher: one request per batch."""
+
+    def __init__(self, latency=0, error_rate=0, batch_size=1000):
+        _Fake.__init__(self, latency, error_rate)
+        self.batch_size = batch_size
+        self.sent = []
+
+    def batches(self, emails):
+        """(sender, emails) batches of at most batch_size, as SendGridBatcher
+        makes them."""
+        by_sender = {}
+        for email in emails:
+            by_sender.setdefault((email.from_email, email.from_name), []).append(email)
+        return [(sender, group[i:i + self.batch_size])
+                for sender, group in by_sender.items()
+                for i in range(0, len(group), self.batch_size)]
+
+    def send_batch(self, sender, emails):
+        """One request for one batch; returns its Report."""
+        report = Report()
+        start = time.time()
+        try:
+            self._request()
+        except InjectedError as e:
+            report.failed.extend((email.key, 'email', e) for email in emails)
+        else:
+            with self._lock:
+                self.sent.extend(emails)
+            report.sent.extend((email.key, 'email') for email in emails)
+        report.elapsed = time.time() - start
+        return report
+
+    def send(self, emails):
+        report = Report()
+        start = time.time()
+        for sender, batch in self.batches(emails):
+            report.extend(self.send_batch(sender, batch))
+        report.elapsed = time.time() - start
+        return report
+
+
+def install(module, latency=0, error_rate=0):
+    """Replace module's sms and mailer (schedule_jobs) with in-process fakes;
+    returns (sms, mailer)."""
+    module.sms = FakeSms(latency, error_rate)
+    module.mailer = FakeMailer(latency, error_rate)
+    return module.sms, module.mailer
@@ -0,0 +1,125 @@
+"""Seed N events due today and time schedule_jobs.job() end to end against
+fake providers.
+
+Run from the repo root against a throwaway database:
+    createdb project_load
+    PYTHONPATH=.:testing python testing/load_test.py 10000 --latency 0.05
+    PYTHONPATH=.:testing python testing/load_test.py 10000 --http --save base.json
+    PYTHONPATH=.:testing python testing/load_test.py 10000 --http --compare base.json
+
+In-process fakes (the default) isolate the scheduler's own overhead; --http
+runs the real SendGrid/Twilio transports against local fake servers.
+"""
+from flask import Flask
+from model import Contact, ContactEvent, Event, Template, User, db, connect_to_db
+from delivery import percentile
+from email_backend import SendGridBatcher
+from sms_transport import SmsTransport
+from fakes import FakeSendGrid, FakeTwilio, install, serve
+import schedule_jobs
+import argparse, datetime, json, resource, time
+
+LOAD_DB = "postgresql:///project_load"
+CHUNK = 5000
+
+
+def seed(n, day):
+    """n events due on day: one contact and template each, 50 per user."""
+    db.drop_all()
+    db.create_all()
+    n_users = max(1, n // 50)
+    tables = [
+        (User.__table__, [{'id': i, 'email': 'u{}@example.com'.format(i), 'password': 'x',
+                           'fname': 'User{}'.format(i), 'phone': '+1555{:07d}'.format(i),
+                           'timezone': 'America/Los_Angeles'}
+                          for i in range(1, n_users + 1)]),
+        (Contact.__table__, [{'id': i, 'name': 'Contact {}'.format(i),
+                              'email': 'c{}@example.com'.format(i),
+                              'phone': '+1666{:07d}'.format(i),
+                              'user_id': (i - 1) % n_users + 1}
+                             for i in range(1, n + 1)]),
+        (Template.__table__, [{'id': i, 'name': 'hello', 'text': 'Hi there {}'.format(i)}
+                              for i in range(1, n + 1)]),
+        (Event.__table__, [{'id': i, 'contact_id': i, 'template_id': i, 'date': day,
+                            'user_id': (i - 1) % n_users + 1,
+                            'job_done': False, 'reminder_sent': True}
+                           for i in range(1, n + 1)]),
+        (ContactEvent.__table__, [{'id': i, 'contact_id': i, 'event_id': i}
+                                  for i in range(1, n + 1)]),
+    ]
+    for table, rows in tables:
+        for i in range(0, len(rows), CHUNK):
+            db.session.execute(table.insert(), rows[i:i + CHUNK])
+    db.session.commit()
+
+
+def use_http_fakes(latency, error_rate):
+    """Point real transports at local fake servers; returns (sms, mailer, servers)."""
+    class Twilio(FakeTwilio):
+        received = []
+    class SendGrid(FakeSendGrid):
+        received = []
+    for handler in (Twilio, SendGrid):
+        handler.latency, handler.error_rate = latency, error_rate
+    servers = [serve(Twilio), serve(SendGrid)]
+    schedule_jobs.sms = SmsTransport('AC' + '0' * 32, 'token', '+15550000000',
+                                     pool_size=schedule_jobs.get_delivery().pools['twilio'].size,
+                                     base_url=servers[0].url)
+    schedule_jobs.mailer = SendGridBatcher('key', host=servers[1].url)
+    return schedule_jobs.sms.http, schedule_jobs.mailer, servers
+
+
+def run(n, latency, error_rate, http):
+    day = datetime.datetime.now()
+    seed(n, datetime.datetime(day.year, day.month, day.day))
+    servers = []
+    if http:
+        sms, mailer, servers = use_http_fakes(latency, error_rate)
+    else:
+        sms, mailer = install(schedule_jobs, latency, error_rate)
+
+    start = time.time()
+    schedule_jobs.job()
+    elapsed = time.time() - start
+    for server in servers:
+        server.stop()
+
+    done = Event.query.filter(Event.job_done == True).count()
+    messages = 2 * n    # every seeded contact has an email and a phone
+    return {
+        'events': n,
+        'events_done': done,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(messages / elapsed, 1),
+        'sms_p50_ms': round(percentile(list(sms.latencies), 50) * 1000, 2),
+        'sms_p99_ms': round(percentile(list(sms.latencies), 99) * 1000, 2),
+        'email_requests': len(mailer.latencies),
+        'email_p50_ms': round(percentile(list(mailer.latencies), 50) * 1000, 2),
+        'email_p99_ms': round(percentile(list(mailer.latencies), 99) * 1000, 2),
+        'peak_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('events', type=int, nargs='?', default=10000)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per provider request")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--http', action='store_true', help="use the local fake HTTP servers")
+    parser.add_argument('--db', default=LOAD_DB)
+    parser.add_argument('--save', help="write results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON file to compare against")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    connect_to_db(app, args.db)
+    results = run(args.events, args.latency, args.error_rate, args.http)
+    baseline = json.load(open(args.compare)) if args.compare else {}
+    for key in sorted(results):
+        line = "{:<22} {:>12}".format(key, results[key])
+        if key in baseline and baseline[key]:
+            line += "   ({:+.1f}% vs baseline)".format(
+                (results[key] - baseline[key]) * 100.0 / baseline[key])
+        print line
+    if args.save:
+        json.dump(results, open(args.save, 'w'), indent=2)
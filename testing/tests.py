@@ -324,6 +324,887 @@ class UserTests(unittest.TestCase):
 
 
 
+####### scheduler ########
+
+class SchedulerTests(unittest.TestCase):
+    """Tests for the scheduler's database scans."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def test_due_events_range(self):
+        """Events later in the day and across month ends are found."""
+        from schedule_jobs import return_due_events
+        last_of_month = datetime.datetime(2018, 1, 31, 15, 30)
+        event = Event.query.get(1)
+        event.date = datetime.datetime(2018, 2, 1)
+        other = Event.query.get(2)
+        other.date = last_of_month
+        db.session.commit()
+        tmrw = last_of_month + datetime.timedelta(days=1)
+        self.assertEqual(return_due_events(tmrw, Event.reminder_sent), [event])
+        self.assertEqual(return_due_events(last_of_month, Event.job_done), [other])
+
+    def test_due_events_pending_only(self):
+        """Rows whose flag is already set are not returned."""
+        from schedule_jobs import return_due_events
+        event = Event.query.get(1)
+        event.job_done = True
+        db.session.commit()
+        self.assertNotIn(event, return_due_events(event.date, Event.job_done))
+
+    def test_mark_events(self):
+        """Flags are set in bulk and other events are left alone."""
+        from schedule_jobs import mark_events
+        mark_events([1, 2], 'job_done')
+        done = [e.id for e in Event.query.filter(Event.job_done == True).order_by(Event.id)]
+        self.assertEqual(done, [1, 2])
+
+    def test_hourly_dispatch_by_timezone_and_shard(self):
+        """Each zone is handled on its own local day, split by user shard."""
+        from schedule_jobs import zones_due, return_due_events
+        bob = User.query.get(2)
+        bob.timezone = 'America/New_York'
+        db.session.commit()
+        # 06:00 UTC is already 12/30 in New York but still 12/29 in LA
+        days = zones_due(datetime.datetime(2017, 12, 30, 6))
+        self.assertEqual(days[datetime.datetime(2017, 12, 30)], ['America/New_York'])
+        self.assertEqual(days[datetime.datetime(2017, 12, 29)], ['America/Los_Angeles'])
+        day = datetime.datetime(2017, 12, 30)
+        self.assertEqual([e.id for e in return_due_events(day, Event.job_done,
+                                                          ['America/New_York'], (0, 2))], [1])
+        self.assertEqual(return_due_events(day, Event.job_done,
+                                           ['America/New_York'], (1, 2)), [])
+
+    def test_next_due_time(self):
+        """The scheduler wakes for the earliest reminder or send."""
+        from schedule_jobs import next_due_time
+        # Ian's 12/30 event is reminded on 12/29
+        self.assertEqual(next_due_time(datetime.datetime(2017, 12, 20)),
+                         datetime.datetime(2017, 12, 29))
+        # already due: run now
+        now = datetime.datetime(2017, 12, 29, 10, 0)
+        self.assertEqual(next_due_time(now), now)
+
+    def test_enqueue_and_claim(self):
+        """Outbox filling is idempotent and a claimed row isn't re-claimed."""
+        from schedule_jobs import enqueue_due_events
+        from outbox_worker import claim
+        from model import Outbox
+        event = Event.query.get(1)
+        now = event.date
+        enqueue_due_events(now)
+        enqueue_due_events(now)
+        # Ian has no phone, so only the email goes out on the day
+        rows = Outbox.query.filter(Outbox.event_id == 1, Outbox.kind == 'contact').all()
+        self.assertEqual([r.channel for r in rows], ['email'])
+        claimed = claim('test-worker')
+        self.assertIn(rows[0], claimed)
+        self.assertEqual(claim('other-worker'), [])
+
+    def test_enqueue_marks_unreachable_done(self):
+        """An event whose contact has no email or phone is done, not queued."""
+        from schedule_jobs import enqueue_due_events
+        from model import Outbox
+        event = Event.query.get(1)
+        now = event.date
+        contact = Contact.query.get(event.contact_id)
+        contact.email = contact.phone = None
+        db.session.commit()
+        enqueue_due_events(now)
+        self.assertEqual(Outbox.query.filter(Outbox.event_id == 1,
+                                             Outbox.kind == 'contact').count(), 0)
+        self.assertTrue(Event.query.get(1).job_done)
+
+
+class ProfileTests(unittest.TestCase):
+    """Tests for the /profile page's queries."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 2
+        # ids repeat across tests, so start each with an empty cache
+        from fragment_cache import fragments, LRUBackend
+        fragments.backend = LRUBackend()
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def count_queries(self, url):
+        from sqlalchemy import event
+        statements = []
+        def before(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before)
+        try:
+            result = self.client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before)
+        return result, len(statements)
+
+    def test_profile_query_count(self):
+        """The page costs the same number of queries for 2 or 52 contacts."""
+        import fragment_cache
+        result, few = self.count_queries('/profile')
+        self.assertIn("Ian Interviewer", result.data)
+        for i in range(50):
+            contact = Contact(name='Friend {}'.format(i), email='f{}@gmail.com'.format(i),
+                              user_id=2)
+            template = Template(name='hi {}'.format(i), text='hello')
+            db.session.add_all([contact, template])
+            db.session.flush()
+            db.session.add(Event(contact_id=contact.id, user_id=2, template_id=template.id,
+                                 date=datetime.datetime(2030, 1, 1)))
+        db.session.commit()
+        db.session.expunge_all()
+        fragment_cache.bump(2)
+        result, many = self.count_queries('/profile')
+        self.assertIn("Friend 49", result.data)
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 4)
+
+    def test_profile_sorted(self):
+        """Contacts come back by name and queued events by date."""
+        from profile_view import load_profile
+        profile = load_profile(2)
+        self.assertEqual([c.name for c in profile.contacts],
+                         ['Ian Interviewer', 'Sally Secretary'])
+        dates = [event.date for event, contact in profile.upcoming]
+        self.assertEqual(dates, sorted(dates))
+
+
+    def test_profile_fragments_cached_until_edit(self):
+        """A repeat view reads only the user; an edit shows up straight away."""
+        self.count_queries('/profile')
+        result, queries = self.count_queries('/profile')
+        self.assertEqual(queries, 1)
+        self.client.post('/edit_contact/3', data={'name': 'Ian Renamed', 'email': 'i@gmail.com'})
+        result, queries = self.count_queries('/profile')
+        self.assertIn("Ian Renamed", result.data)
+        self.assertGreater(queries, 1)
+
+    def test_contacts_json_revalidates(self):
+        """Unchanged contacts get a 304; an edit changes the ETag."""
+        import json
+        result = self.client.get('/contacts.json?ids=1,2,3')
+        # contact 1 is Jane's, so only Bob's two come back
+        self.assertEqual([c['id'] for c in json.loads(result.data)['contacts']], [2, 3])
+        etag = result.headers['ETag']
+        again = self.client.get('/contacts.json?ids=3,2', headers={'If-None-Match': etag})
+        self.assertEqual(again.status_code, 304)
+        self.client.post('/edit_contact/3', data={'name': 'Ian Renamed', 'email': 'i@gmail.com'})
+        changed = self.client.get('/contacts.json?ids=2,3', headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+
+    def test_api_contacts_pages(self):
+        """Keyset pages cover every contact once, in (name, id) order."""
+        import json, profile_view
+        for name in ['Ann', 'Ann', 'Zed']:
+            db.session.add(Contact(name=name, email='x@gmail.com', user_id=2))
+        db.session.commit()
+        profile_view.PAGE_SIZE, page_size = 2, profile_view.PAGE_SIZE
+        seen, after = [], None
+        try:
+            while True:
+                data = json.loads(self.client.get('/api/contacts',
+                                                  query_string={'after': after or ''}).data)
+                seen.extend((c['name'], c['id']) for c in data['contacts'])
+                after = data['next']
+                if not after:
+                    break
+        finally:
+            profile_view.PAGE_SIZE = page_size
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(seen), Contact.query.filter(Contact.user_id == 2).count())
+
+    def test_api_bad_cursors(self):
+        """Cursors of the wrong shape are treated as missing rather than a 500."""
+        import base64, json
+        bad = [[1, 2], ['Ann'], {'a': 1}, ['Ann', 'x'], ['not a date', 1], 'garbage']
+        for path in ['/api/contacts', '/api/events', '/api/history']:
+            for value in bad:
+                after = base64.urlsafe_b64encode(json.dumps(value))
+                result = self.client.get(path, query_string={'after': after})
+                self.assertEqual(result.status_code, 200, (path, value))
+
+
+class ContactImportTests(unittest.TestCase):
+    """Tests for bulk Facebook contact import."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def test_import_skips_existing_and_reports_failures(self):
+        from contact_import import import_contacts
+        friends = [[u'Sally Secretary', 'http://pic/1'],    # Bob already has her
+                   [u'New Friend', 'http://pic/2'],
+                   [u'New Friend', 'http://pic/3'],         # duplicate in the list
+                   [u'No Picture', None],
+                   ['', 'http://pic/4'],
+                   'not a pair']
+        result = import_contacts(2, friends)
+        self.assertEqual(result['added'], 2)
+        self.assertEqual(result['skipped'], 2)
+        self.assertEqual([f['index'] for f in result['failed']], [4, 5])
+        names = [c.name for c in Contact.query.filter(Contact.user_id == 2).order_by(Contact.name)]
+        self.assertEqual(names, ['Ian Interviewer', 'New Friend', 'No Picture',
+                                 'Sally Secretary'])
+        no_pic = Contact.query.filter(Contact.name == 'No Picture').one()
+        self.assertEqual(no_pic.pic_url, '/static/defaultpic.jpg')
+
+    def test_import_job_progress(self):
+        """A job imports slice by slice and keeps failure indexes absolute."""
+        import contact_import, json
+        from model import ImportJob
+        friends = [[u'Friend {}'.format(i), None] for i in range(5)] + [['', None]]
+        job = ImportJob(user_id=2, payload=json.dumps(friends), total=len(friends))
+        db.session.add(job)
+        db.session.commit()
+        contact_import.SLICE, slice_size = 2, contact_import.SLICE
+        try:
+            contact_import.run_import(job.id)
+        finally:
+            contact_import.SLICE = slice_size
+        status = contact_import.job_status(ImportJob.query.get(job.id))
+        self.assertEqual((status['status'], status['processed'], status['added']),
+                         ('done', 6, 5))
+        self.assertEqual([f['index'] for f in status['failed']], [5])
+
+    def test_running_job_is_left_to_its_worker(self):
+        """Only pending jobs and claims gone stale are resumed or run."""
+        import contact_import, json
+        from model import ImportJob
+        job = ImportJob(user_id=2, payload=json.dumps([[u'Friend', None]]), total=1,
+                        status='running', claimed_by='elsewhere',
+                        claimed_at=datetime.datetime.now())
+        db.session.add(job)
+        db.session.commit()
+        job_id = job.id
+
+        class Recorder(object):
+            def __init__(self):
+                self.submitted = []
+
+            def submit(self, fn, *args):
+                self.submitted.append(args)
+
+        contact_import._pool, pool = Recorder(), contact_import._pool
+        try:
+            self.assertEqual(contact_import.resume_imports(), 0)
+            contact_import.run_import(job_id)
+            self.assertEqual(ImportJob.query.get(job_id).processed, 0)
+
+            ImportJob.query.filter(ImportJob.id == job_id).update(
+                {'claimed_at': datetime.datetime.now() - datetime.timedelta(
+                    seconds=contact_import.IMPORT_LEASE_SECONDS + 60)})
+            db.session.commit()
+            self.assertEqual(contact_import.resume_imports(), 1)
+            self.assertEqual(contact_import._pool.submitted, [(job_id,)])
+        finally:
+            contact_import._pool = pool
+        contact_import.run_import(job_id)
+        job = ImportJob.query.get(job_id)
+        self.assertEqual((job.status, job.processed, job.added), ('done', 1, 1))
+
+
+class EventBatchTests(unittest.TestCase):
+    """Tests for creating events in bulk."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 2
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def post_batch(self, entries):
+        import json
+        result = self.client.post('/api/events/batch', data=json.dumps({'events': entries}),
+                                  content_type='application/json')
+        return result.status_code, json.loads(result.data)
+
+    def test_batch_creates_everything(self):
+        entries = [{'contact_id': 2, 'date': '2030-05-01', 'template_name': 'hb',
+                    'body': 'Happy birthday!'},
+                   {'name': 'New Person', 'email': 'np@gmail.com', 'date': '2030-05-02',
+                    'template_name': 'hb', 'body': 'Happy birthday!'}]
+        status, data = self.post_batch(entries)
+        self.assertEqual(status, 200)
+        events = Event.query.filter(Event.id.in_(data['created'])).order_by(Event.id).all()
+        self.assertEqual([e.contacts[0].name for e in events],
+                         ['Sally Secretary', 'New Person'])
+        self.assertEqual(events[0].template.text, u"Hi Sally, \nHappy birthday! \nBest,\nBob")
+
+    def test_batch_is_all_or_nothing(self):
+        before = Event.query.count()
+        status, data = self.post_batch([{'contact_id': 2, 'date': '2030-05-01',
+                                         'template_name': 'hb', 'body': 'hi'},
+                                        {'contact_id': 1, 'date': '2030-05-01',
+                                         'template_name': 'hb', 'body': 'not my contact'}])
+        self.assertEqual(status, 400)
+        self.assertEqual(data['entries'], [{'index': 1, 'error': 'no such contact'}])
+        self.assertEqual(Event.query.count(), before)
+
+    def test_non_numeric_contact_id_is_rejected(self):
+        status, data = self.post_batch([{'contact_id': 'abc', 'date': '2030-05-01',
+                                         'template_name': 'hb', 'body': 'hi'}])
+        self.assertEqual(status, 400)
+        self.assertEqual(data['entries'], [{'index': 0,
+                                            'error': 'contact_id must be an integer'}])
+
+
+class RemovalTests(unittest.TestCase):
+    """Tests for set-based deletes."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        self.client = app.test_client()
+        app.config['TESTING'] = True
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 2
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def test_remove_contacts_cascades(self):
+        """Events, templates and links go with the contacts; Jane's John stays."""
+        import json
+        result = self.client.post('/remove_contacts', content_type='application/json',
+                                  data=json.dumps({'contact_ids': [1, 2, 3]}))
+        self.assertEqual(json.loads(result.data), {'deleted': 2})
+        self.assertEqual([c.name for c in Contact.query.all()], ['John Recruitor'])
+        self.assertEqual([e.id for e in Event.query.all()], [2])
+        self.assertEqual(Template.query.count(), 1)
+        self.assertEqual(ContactEvent.query.count(), 1)
+
+    def test_remove_event(self):
+        self.client.post('/remove_event', data={'event_id': 1})
+        self.assertIsNone(Event.query.get(1))
+        self.assertEqual(ContactEvent.query.filter(ContactEvent.event_id == 1).count(), 0)
+        # event 4 still sends the same follow up
+        self.assertEqual(Template.query.count(), 2)
+        self.client.post('/remove_event', data={'event_id': 4})
+        self.assertEqual([t.name for t in Template.query.all()], ['thank you'])
+
+    def test_bad_ids_redirect(self):
+        """Missing or non-numeric ids are flashed back, not a 500."""
+        for path, field in [('/remove_event', 'event_id'), ('/remove_contact', 'contact_id')]:
+            for data in [{}, {field: 'abc'}]:
+                result = self.client.post(path, data=data)
+                self.assertEqual(result.status_code, 302, (path, data))
+        self.assertEqual(Event.query.count(), 4)
+        self.assertEqual(Contact.query.count(), 3)
+
+
+class PasswordTests(unittest.TestCase):
+    """Tests for password hashing."""
+
+    def test_hash_and_verify(self):
+        import passwords
+        stored = passwords.hash_password(u'hunter2')
+        self.assertTrue(stored.startswith(passwords.current_method() + '$'))
+        self.assertEqual(passwords.verify(stored, u'hunter2'), (True, False))
+        self.assertEqual(passwords.verify(stored, u'wrong'), (False, False))
+
+    def test_login_upgrades_old_hashes(self):
+        import passwords
+        from werkzeug.security import generate_password_hash
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        try:
+            example_data()
+            jane = User.query.get(1)
+            jane.password = generate_password_hash('a', 'pbkdf2:sha1:1000')
+            db.session.commit()
+            result = app.test_client().post('/login', data={'login_email': 'j@gmail.com',
+                                                            'login_password': 'a'})
+            self.assertTrue(result.location.endswith('/profile'))
+            db.session.expire_all()
+            self.assertFalse(passwords.needs_rehash(User.query.get(1).password))
+        finally:
+            db.session.close()
+            db.drop_all()
+
+
+class SmsWebhookTests(unittest.TestCase):
+    """Tests for replies to reminder texts."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        self.client = app.test_client()
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def test_phone_normalized(self):
+        from phones import to_e164
+        self.assertEqual(to_e164('(098) 765-4321'), '+10987654321')
+        self.assertEqual(to_e164('0044 20 7946 0958'), '+442079460958')
+        self.assertIsNone(to_e164('123'))
+        self.assertEqual(User.query.get(2).phone_e164, '+10987654321')
+
+    def test_reply_without_event_id_lists_tomorrows_events(self):
+        # event 3 was created with the default date, tomorrow
+        result = self.client.post('/sms', data={'From': '(098) 765-4321', 'Body': 'hello'})
+        self.assertIn("'event_id=3'", result.data)
+        self.assertNotIn("'event_id=1'", result.data)
+
+    def test_reply_updates_own_event_only(self):
+        self.client.post('/sms', data={'From': '+10987654321', 'Body': 'New text event_id=3'})
+        self.client.post('/sms', data={'From': '+10987654321', 'Body': 'Sneaky event_id=2'})
+        self.assertEqual(Event.query.get(3).template.text, 'New text')
+        self.assertEqual(Event.query.get(2).template.text, 'thank you for meeting!')
+
+
+class MigrationTests(unittest.TestCase):
+    """Tests for the versioned schema migrations."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+        db.engine.execute("DROP TABLE IF EXISTS schema_version")
+
+    def test_upgrade_records_versions(self):
+        import migrations
+        self.assertEqual(len(migrations.pending()), len(migrations.MIGRATIONS))
+        migrations.upgrade()
+        self.assertEqual(migrations.pending(), [])
+        self.assertEqual(set(migrations.applied()),
+                         set(m.name for m in migrations.MIGRATIONS))
+        # a second run has nothing left to do
+        migrations.upgrade()
+        self.assertEqual(len(migrations.applied()), len(migrations.MIGRATIONS))
+
+
+class ReplicaRoutingTests(unittest.TestCase):
+    """Tests for sending reads to the replica, with two SQLite files standing
+    in for the primary and the replica."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        connect_to_db(app, "sqlite:///{}/primary.db".format(self.dir),
+                      replica_uri="sqlite:///{}/replica.db".format(self.dir),
+                      pre_ping=True)
+        db.create_all()
+        db.Model.metadata.create_all(db.get_engine(app, 'replica'))
+        db.session.add(User('jane@gmail.com', 'x', 'Jane', 'Doe'))
+        db.session.commit()
+
+    def tearDown(self):
+        """Do at end of every test."""
+        import shutil
+        db.session.remove()
+        shutil.rmtree(self.dir)
+
+    def test_reads_go_to_replica(self):
+        from model import replica
+        self.assertEqual(User.query.count(), 1)
+        with replica():
+            self.assertEqual(User.query.count(), 0)
+        self.assertEqual(User.query.count(), 1)
+
+    def test_writes_go_to_primary(self):
+        from model import replica
+        with replica():
+            db.session.add(User('bob@gmail.com', 'x', 'Bob', 'Smith'))
+            db.session.commit()
+            self.assertEqual(User.query.count(), 0)
+        self.assertEqual(User.query.count(), 2)
+
+    def test_pool_settings(self):
+        # sqlite doesn't pool; building the engine doesn't connect
+        connect_to_db(app, "postgresql:///project", pool_size=3, max_overflow=0,
+                      pool_recycle=60)
+        pool = db.engine.pool
+        self.assertEqual((pool.size(), pool._max_overflow, pool._recycle), (3, 0, 60))
+
+
+class ArchiveTests(unittest.TestCase):
+    """Tests for moving sent events into event_history."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        self.client = app.test_client()
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+        # Bob's events 1 and 4 are from 2017/2018; 3 is still queued
+        Event.query.filter(Event.id.in_([1, 4])).update({'job_done': True},
+                                                        synchronize_session=False)
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 2
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def test_archive_moves_sent_events(self):
+        from archive import archive
+        from model import EventHistory
+        self.assertEqual(archive(batch_size=1), 2)
+        self.assertEqual(sorted(e.id for e in Event.query.all()), [2, 3])
+        # 1 and 4 shared the follow up; 2 and 3 still share the thank you
+        self.assertEqual([t.name for t in Template.query.all()], ['thank you'])
+        self.assertEqual(ContactEvent.query.count(), 2)
+        history = EventHistory.query.get((1, datetime.datetime(2017, 12, 30)))
+        self.assertEqual((history.template_name, history.template_text),
+                         ('follow up', 'hello there'))
+        self.assertEqual(archive(), 0)
+
+    def test_history_page(self):
+        import json
+        from archive import archive
+        archive()
+        result = json.loads(self.client.get('/api/history').data)
+        self.assertEqual([e['id'] for e in result['events']], [4, 1])
+        self.assertIsNone(result['next'])
+
+
+class RecurrenceTests(unittest.TestCase):
+    """Tests for repeating events."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+        # Bob's Dec 30 follow up repeats every year and was just sent
+        event = Event.query.get(1)
+        event.recurrence, event.recurs_from = 'yearly', event.date
+        event.job_done = event.reminder_sent = True
+        db.session.commit()
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def test_next_occurrence(self):
+        from recurrence import next_occurrence
+        d = datetime.datetime
+        self.assertEqual(next_occurrence('yearly', 1, d(2016, 2, 29), d(2016, 2, 29)),
+                         d(2017, 2, 28))
+        self.assertEqual(next_occurrence('yearly', 1, d(2016, 2, 29), d(2019, 3, 1)),
+                         d(2020, 2, 29))
+        self.assertEqual(next_occurrence('monthly', 1, d(2018, 1, 31), d(2018, 2, 28)),
+                         d(2018, 3, 31))
+        self.assertEqual(next_occurrence('daily', 3, d(2018, 1, 1), d(2018, 1, 5)),
+                         d(2018, 1, 7))
+
+    def test_sent_event_moves_to_next_year(self):
+        from model import Outbox
+        from recurrence import advance_sent
+        db.session.add(Outbox(event_id=1, kind='contact', channel='email', status='sent'))
+        db.session.commit()
+        self.assertEqual(advance_sent(now=datetime.datetime(2017, 12, 30, 9)), 1)
+        event = Event.query.get(1)
+        self.assertEqual(event.date, datetime.datetime(2018, 12, 30))
+        self.assertFalse(event.job_done or event.reminder_sent)
+        self.assertEqual(Outbox.query.count(), 0)
+        self.assertEqual(Event.query.count(), 4)
+
+    def test_moved_date_restarts_series(self):
+        from recurrence import advance_sent
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = 2
+        client.post('/handle_edits', data={
+            'event_id': 1, 'contact_name': 'Ian Interviewer', 'template_text': 'hello there',
+            'contact_email': 'i@gmail.com', 'contact_phone': '', 'contact_address': '',
+            'date': '2018-01-05', 'recurrence': 'yearly', 'recur_every': '1'})
+        event = Event.query.get(1)
+        self.assertEqual(event.recurs_from, datetime.datetime(2018, 1, 5))
+        event.job_done = True
+        db.session.commit()
+        advance_sent(now=datetime.datetime(2018, 1, 5, 9))
+        self.assertEqual(Event.query.get(1).date, datetime.datetime(2019, 1, 5))
+
+    def test_waits_for_retries(self):
+        from model import Outbox
+        from recurrence import advance_sent
+        db.session.add(Outbox(event_id=1, kind='contact', channel='sms', status='pending'))
+        db.session.commit()
+        self.assertEqual(advance_sent(), 0)
+        self.assertTrue(Event.query.get(1).job_done)
+
+    def test_failed_row_does_not_hold_back_series(self):
+        """A channel that failed for good still lets the event move on."""
+        from model import Outbox
+        from outbox_worker import FLAG_SQL
+        from recurrence import advance_sent
+        Event.query.get(1).job_done = False
+        db.session.add(Outbox(event_id=1, kind='contact', channel='email', status='sent'))
+        db.session.add(Outbox(event_id=1, kind='contact', channel='sms', status='failed',
+                              attempts=5))
+        db.session.commit()
+        db.session.execute(FLAG_SQL.format(flag='job_done'), {'event_ids': (1,),
+                                                              'kind': 'contact'})
+        db.session.commit()
+        self.assertTrue(Event.query.get(1).job_done)
+        self.assertEqual(advance_sent(now=datetime.datetime(2017, 12, 30, 9)), 1)
+        self.assertEqual(Event.query.get(1).date, datetime.datetime(2018, 12, 30))
+
+
+class TemplateStoreTests(unittest.TestCase):
+    """Tests for shared, content-addressed templates."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+        self.client = app.test_client()
+        connect_to_db(app, "postgresql:///project")
+        db.create_all()
+        example_data()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 2
+
+    def tearDown(self):
+        """Do at end of every test."""
+        db.session.close()
+        db.drop_all()
+
+    def test_identical_messages_share_a_row(self):
+        from event_batch import create_events
+        self.assertEqual(Template.query.count(), 2)
+        entry = {'contact_id': 2, 'date': '2018-02-01', 'template_name': 'hb',
+                 'body': 'Happy birthday!'}
+        first, second = create_events(User.query.get(2), [entry, dict(entry, contact_id=3)])
+        self.assertEqual(Event.query.get(first).template_id, Event.query.get(second).template_id)
+        self.assertEqual(Template.query.count(), 3)
+
+    def test_edit_copies_shared_template(self):
+        self.client.post('/handle_edits', data={
+            'event_id': 1, 'contact_name': 'Ian Interviewer', 'template_text': 'hi again',
+            'contact_email': 'i@gmail.com', 'contact_phone': '', 'contact_address': '',
+            'date': '2017-12-30'})
+        self.assertEqual(Event.query.get(1).template.text, 'hi again')
+        self.assertEqual(Event.query.get(4).template.text, 'hello there')
+        self.assertEqual(Template.query.count(), 3)
+
+    def test_edit_rejects_missing_text(self):
+        form = {'event_id': 1, 'contact_name': 'Ian Interviewer',
+                'contact_email': 'i@gmail.com', 'contact_phone': '', 'contact_address': '',
+                'date': '2017-12-30'}
+        for text in [None, '  ']:
+            if text is not None:
+                form['template_text'] = text
+            result = self.client.post('/handle_edits', data=form)
+            self.assertEqual(result.status_code, 302)
+            with self.client.session_transaction() as sess:
+                flashes = [message for _, message in sess.pop('_flashes', [])]
+            self.assertIn("Couldn't update that message: the message can't be empty", flashes)
+        self.assertEqual(Event.query.get(1).template.text, 'hello there')
+
+    def test_digest_matches_migration(self):
+        from model import template_digest
+        name, text = u'caf\xe9', u'see you 9:30'
+        sql = db.session.execute("SELECT encode(sha256(convert_to("
+                                 "length(:n) || ':' || :n || :t, 'UTF8')), 'hex')",
+                                 {'n': name, 't': text}).scalar()
+        self.assertEqual(sql, template_digest(name, text))
+
+
+class DeliveryTests(unittest.TestCase):
+    """Tests for the concurrent delivery engine (no providers needed)."""
+
+    def test_failures_stay_per_channel(self):
+        from delivery import DeliveryEngine, Message
+        def boom():
+            raise RuntimeError("provider down")
+        engine = DeliveryEngine({'sendgrid': 2, 'twilio': 2})
+        report = engine.deliver([Message(1, 'email', 'sendgrid', lambda: 202),
+                                 Message(1, 'sms', 'twilio', boom),
+                                 Message(2, 'email', 'sendgrid', lambda: 202)])
+        self.assertEqual(sorted(report.sent), [(1, 'email'), (2, 'email')])
+        self.assertFalse(report.ok(1))
+        self.assertTrue(report.ok(2))
+
+    def test_in_flight_capped_per_provider(self):
+        from delivery import DeliveryEngine, Message
+        import threading, time
+        lock = threading.Lock()
+        state = {'now': 0, 'peak': 0}
+        def slow():
+            with lock:
+                state['now'] += 1
+                state['peak'] = max(state['peak'], state['now'])
+            time.sleep(0.01)
+            with lock:
+                state['now'] -= 1
+        engine = DeliveryEngine({'twilio': 3})
+        engine.deliver([Message(i, 'sms', 'twilio', slow) for i in range(20)])
+        self.assertEqual(state['peak'], 3)
+
+    def test_email_batches_fan_out(self):
+        """Each sender's batch is its own task on the sendgrid pool."""
+        import schedule_jobs, threading, time
+        from delivery import DeliveryEngine, Report
+        from email_backend import OutgoingEmail
+        lock = threading.Lock()
+        state = {'now': 0, 'peak': 0}
+        class SlowMailer(object):
+            def batches(self, emails):
+                return [((e.from_email, e.from_name), [e]) for e in emails]
+            def send_batch(self, sender, emails):
+                with lock:
+                    state['now'] += 1
+                    state['peak'] = max(state['peak'], state['now'])
+                time.sleep(0.01)
+                with lock:
+                    state['now'] -= 1
+                report = Report()
+                report.sent.extend((e.key, 'email') for e in emails)
+                return report
+        emails = [OutgoingEmail(i, 'u{}@gmail.com'.format(i), 'U', 'c@a.com', 'C', 'hi', 'yo')
+                  for i in range(12)]
+        mailer, schedule_jobs.mailer = schedule_jobs.mailer, SlowMailer()
+        try:
+            report = schedule_jobs.deliver(emails, [], DeliveryEngine({'sendgrid': 4,
+                                                                        'twilio': 1}))
+        finally:
+            schedule_jobs.mailer = mailer
+        self.assertEqual(len(report.sent), 12)
+        self.assertEqual(state['peak'], 4)
+
+    def test_deliver_with_installed_fakes(self):
+        """The load test's in-process fakes still fit deliver()."""
+        import schedule_jobs
+        from delivery import DeliveryEngine, Message
+        from email_backend import OutgoingEmail
+        from fakes import install
+        from functools import partial
+        emails = [OutgoingEmail(i, 'u{}@gmail.com'.format(i % 2), 'U', 'c@a.com', 'C', 'hi', 'yo')
+                  for i in range(5)]
+        texts = [Message(9, 'sms', 'twilio', partial(schedule_jobs.send_text, '+15551234567', 'hi'))]
+        saved = schedule_jobs.sms, schedule_jobs.mailer
+        try:
+            sms, mailer = install(schedule_jobs)
+            report = schedule_jobs.deliver(emails, texts, DeliveryEngine({'sendgrid': 2,
+                                                                          'twilio': 1}))
+        finally:
+            schedule_jobs.sms, schedule_jobs.mailer = saved
+        self.assertEqual(sorted(report.sent), [(i, 'email') for i in range(5)] + [(9, 'sms')])
+        self.assertEqual((mailer.requests, len(mailer.sent), len(sms.sent)), (2, 5, 1))
+
+
+class EmailBackendTests(unittest.TestCase):
+    """Tests for batched SendGrid sends, against a local stub server."""
+
+    def setUp(self):
+        import BaseHTTPServer, json, threading
+        posted = self.posted = []
+        class StubSendGrid(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                posted.append(body)
+                to = [p['to'][0]['email'] for p in body['personalizations']]
+                self.send_response(400 if any(t.startswith('bad') for t in to) else 202)
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubSendGrid)
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batches_by_sender_and_isolates_rejects(self):
+        from email_backend import OutgoingEmail, SendGridBatcher
+        mailer = SendGridBatcher('key', host='http://127.0.0.1:{}'.format(self.server.server_port))
+        emails = [OutgoingEmail(1, 'j@gmail.com', 'Jane', 'a@a.com', 'A', 'hi', 'one'),
+                  OutgoingEmail(2, 'j@gmail.com', 'Jane', 'bad@a.com', 'B', 'hi', 'two'),
+                  OutgoingEmail(3, 'h@gmail.com', 'Bob', 'c@a.com', 'C', 'yo', 'three')]
+        report = mailer.send(emails)
+        self.assertEqual(sorted(report.sent), [(1, 'email'), (3, 'email')])
+        self.assertEqual([key for key, _, _ in report.failed], [2])
+        # Jane's pair went out together, was rejected, then was split
+        self.assertEqual(len(self.posted[0]['personalizations']) +
+                         len(self.posted[1]['personalizations']), 3)
+        self.assertEqual(mailer.requests, 4)
+
+
+class SmsTransportTests(unittest.TestCase):
+    """Tests for the pooled Twilio transport, against the fake endpoint."""
+
+    def test_send_async_and_latency(self):
+        from fakes import FakeTwilio, serve
+        from sms_transport import SmsTransport
+        server = serve(FakeTwilio)
+        try:
+            sms = SmsTransport('AC' + '0' * 32, 'token', '+15550000000',
+                               pool_size=4, base_url=server.url)
+            pending = [sms.send_async('+1555000000{}'.format(i), 'hi') for i in range(8)]
+            messages = [p.result(timeout=10) for p in pending]
+            self.assertEqual(set(m.status for m in messages), set(['queued']))
+            self.assertEqual(sms.latency()['count'], 8)
+        finally:
+            server.stop()
+
+
+class MetricsTests(unittest.TestCase):
+    """Tests for the /metrics endpoint."""
+
+    def test_route_latency_exported(self):
+        client = app.test_client()
+        client.get('/quote')
+        result = client.get('/metrics')
+        self.assertIn('http_requests_total{endpoint="return_quote",status="200"}', result.data)
+        self.assertIn('# TYPE http_request_seconds histogram', result.data)
+
+
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file